@@ -2,9 +2,24 @@
 import json
 import bisect
 import os
+import sys
+import time
+import cProfile
+import pstats
+import io
+from contextlib import contextmanager
+import numpy as np
 import networkx as nx
-from datetime import datetime, timedelta
-from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict, deque
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+# 项目根目录 (LE/core/ 的上两级)
+project_root = os.path.abspath(os.path.join(current_dir, "..", ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from tool.timeparse import TimestampParser, parse_iso
 
 # ==========================================
 # 1. 基础工具 (Utils & Loaders)
@@ -36,50 +51,346 @@ def audit_correction_edges(G): # 去掉 self
     print("="*50 + "\n")
 
 
-def parse_dt(t_val):
-    if not t_val or t_val == "None": return datetime.min
-    t_str = str(t_val).replace("T", " ").replace("Z", "")
+def _normalize_ts(t_str):
+    if t_str == "None": return None
+    t_str = t_str.replace("T", " ").replace("Z", "")
     if "@" in t_str: t_str = t_str.split("@")[-1].strip()
-    try:
-        return datetime.fromisoformat(t_str)
-    except ValueError:
-        try:
-            t_part = t_str.split(" ")[-1]
-            dt = datetime.strptime(t_part, "%H:%M:%S.%f")
-            return dt.replace(year=2024, month=1, day=1)
-        except ValueError:
-            return datetime.min
+    return t_str
+
+def _parse_clock(t_str):
+    # 只有时分秒的时间戳，统一落到 2024-01-01
+    dt = datetime.strptime(t_str.split(" ")[-1], "%H:%M:%S.%f")
+    return dt.replace(year=2024, month=1, day=1)
+
+_TS_PARSER = TimestampParser((parse_iso, _parse_clock), normalize=_normalize_ts, default=datetime.min)
+
+def parse_dt(t_val):
+    return _TS_PARSER(t_val)
+
+def _g6_node(node):
+    """G6 节点 dict -> (node_id, attrs)"""
+    attrs = {k: v for k, v in node.items() if k not in ['id', 'label', 'shape', 'color', 'title']}
+    attrs["_dt"] = parse_dt(attrs.get("timestamp"))
+    node_id = node["id"]
+    if "label" not in attrs: attrs["label"] = str(node_id)
+    return node_id, attrs
+
+def _g6_edge(edge):
+    """G6 link dict -> (source, target, attrs)"""
+    edge_attrs = {k: v for k, v in edge.items() if k not in ['source', 'target', 'label', 'type']}
+    edge_type = edge.get("type", "rel")
+    edge_attrs["type"], edge_attrs["label"] = edge_type, edge.get("label", edge_type)
+    return edge["source"], edge["target"], edge_attrs
 
 def load_g6_graph(filepath):
+    if filepath.endswith(BINARY_GRAPH_SUFFIX): return load_graph_binary(filepath)
     print(f"[*] Loading Cyber View Graph...")
     with open(filepath, 'r', encoding='utf-8') as f: data = json.load(f)
     G = nx.DiGraph()
     for node in data.get("nodes", []):
-        attrs = {k: v for k, v in node.items() if k not in ['id', 'label', 'shape', 'color', 'title']}
-        attrs["_dt"] = parse_dt(attrs.get("timestamp"))
-        node_id = node["id"]
-        if "label" not in attrs: attrs["label"] = str(node_id)
+        node_id, attrs = _g6_node(node)
         G.add_node(node_id, **attrs)
     for edge in data.get("links", []):
-        source, target = edge["source"], edge["target"]
-        edge_attrs = {k: v for k, v in edge.items() if k not in ['source', 'target', 'label', 'type']}
-        edge_type = edge.get("type", "rel")
-        edge_label = edge.get("label", edge_type)
-        G.add_edge(source, target, type=edge_type, label=edge_label, **edge_attrs)
+        source, target, edge_attrs = _g6_edge(edge)
+        G.add_edge(source, target, **edge_attrs)
     print(f"[*] Loaded Graph: {G.number_of_nodes()} nodes, {G.number_of_edges()} edges.")
     return G
 
+# ------------------------------------------
+# 二进制图格式 (.npz 列式表)
+#   节点表: kind 编码 (驻留词表) + _dt (datetime64[us], 缺失为 NaT)
+#   边表:   src / dst 节点下标 + type 编码
+#   其余属性与节点 ID 以一个 JSON 块保存，加载时一次性解析
+# ------------------------------------------
+BINARY_GRAPH_SUFFIX = ".npz"
+BINARY_GRAPH_VERSION = 1
+
+def _encode_attr(v):
+    if isinstance(v, datetime): return {"$dt": v.isoformat()}
+    return str(v)
+
+def _decode_attr(obj):
+    if len(obj) == 1 and "$dt" in obj: return datetime.fromisoformat(obj["$dt"])
+    return obj
+
+def _intern_column(values):
+    vocab, codes = {}, []
+    for v in values:
+        codes.append(vocab.setdefault(v, len(vocab)))
+    return list(vocab), np.array(codes, dtype=np.int32)
+
+def save_graph_binary(G, output_path):
+    """把 (推理前或推理后的) 图写成紧凑的列式二进制格式，可与 load_graph_binary 无损往返"""
+    node_ids = list(G.nodes())
+    pos = {n: i for i, n in enumerate(node_ids)}
+    node_attrs, kinds, dts = [], [], []
+    for _, attrs in G.nodes(data=True):
+        rest = dict(attrs)
+        kinds.append(rest.pop("kind", "$absent"))
+        dt = rest.get("_dt")
+        if isinstance(dt, datetime) and dt.tzinfo is None:
+            dts.append(rest.pop("_dt"))
+        else:
+            dts.append(None)
+        node_attrs.append(rest)
+
+    edge_src, edge_dst, types, edge_attrs = [], [], [], []
+    for u, v, attrs in G.edges(data=True):
+        rest = dict(attrs)
+        edge_src.append(pos[u]); edge_dst.append(pos[v])
+        types.append(rest.pop("type", "$absent"))
+        edge_attrs.append(rest)
+
+    kind_vocab, kind_codes = _intern_column(kinds)
+    type_vocab, type_codes = _intern_column(types)
+    meta = {"version": BINARY_GRAPH_VERSION, "node_ids": node_ids, "node_attrs": node_attrs,
+            "edge_attrs": edge_attrs, "kinds": kind_vocab, "types": type_vocab}
+    blob = json.dumps(meta, ensure_ascii=False, separators=(",", ":"), default=_encode_attr).encode("utf-8")
+    np.savez(output_path,
+             meta=np.frombuffer(blob, dtype=np.uint8),
+             node_kind=kind_codes,
+             node_dt=np.array(dts, dtype="datetime64[us]"),
+             edge_src=np.array(edge_src, dtype=np.int32),
+             edge_dst=np.array(edge_dst, dtype=np.int32),
+             edge_type=type_codes)
+    print(f"[*] Binary graph written to {output_path} ({len(node_ids)} nodes, {len(edge_src)} edges).")
+
+def load_graph_binary(filepath):
+    print(f"[*] Loading Binary Graph...")
+    with np.load(filepath, allow_pickle=False) as z:
+        meta = json.loads(z["meta"].tobytes().decode("utf-8"), object_hook=_decode_attr)
+        node_kind, edge_type = z["node_kind"], z["edge_type"]
+        node_dt = z["node_dt"].astype(object)  # NaT -> None，其余为 datetime
+        edge_src, edge_dst = z["edge_src"], z["edge_dst"]
+
+    node_ids, kinds, types = meta["node_ids"], meta["kinds"], meta["types"]
+    nodes = []
+    for i, attrs in enumerate(meta["node_attrs"]):
+        kind = kinds[node_kind[i]]
+        if kind != "$absent": attrs["kind"] = kind
+        if node_dt[i] is not None: attrs["_dt"] = node_dt[i]
+        nodes.append((node_ids[i], attrs))
+    edges = []
+    for i, attrs in enumerate(meta["edge_attrs"]):
+        etype = types[edge_type[i]]
+        if etype != "$absent": attrs["type"] = etype
+        edges.append((node_ids[edge_src[i]], node_ids[edge_dst[i]], attrs))
+
+    G = nx.DiGraph()
+    G.add_nodes_from(nodes)
+    G.add_edges_from(edges)
+    print(f"[*] Loaded Graph: {G.number_of_nodes()} nodes, {G.number_of_edges()} edges.")
+    return G
+
+# ==========================================
+# 1.5 状态预言机 (State Oracle)
+# ==========================================
+class StateOracle:
+    """
+    按实体维护的状态时间轴：时间为 datetime64[us] 数组，状态为驻留 (interned) 后的整数编码。
+    insert 只写入追加缓冲区，查询前按需与已排序数组归并，避免 bisect.insort 的逐条搬移。
+    """
+    def __init__(self, instrumentation=None):
+        self.instr = instrumentation
+        self._times = {}    # entity_id -> np.ndarray[datetime64[us]] (有序)
+        self._codes = {}    # entity_id -> np.ndarray[int32] 状态编码
+        self._nodes = {}    # entity_id -> np.ndarray[object] 节点 ID
+        self._pending = defaultdict(list)
+        self._state_code = {}
+        self._state_names = []
+
+    @staticmethod
+    def _to_dt64(dt):
+        if dt.tzinfo is not None: dt = dt.replace(tzinfo=None)
+        return np.datetime64(dt, "us")
+
+    def _intern(self, state):
+        state = str(state)
+        code = self._state_code.get(state)
+        if code is None:
+            code = self._state_code[state] = len(self._state_names)
+            self._state_names.append(state)
+        return code
+
+    def insert(self, entity_id, dt, state, nid):
+        if entity_id not in self._times:
+            self._times[entity_id] = np.empty(0, dtype="datetime64[us]")
+            self._codes[entity_id] = np.empty(0, dtype=np.int32)
+            self._nodes[entity_id] = np.empty(0, dtype=object)
+        self._pending[entity_id].append((self._to_dt64(dt), self._intern(state), nid))
+
+    def _merge(self, entity_id):
+        pending = self._pending.pop(entity_id, None)
+        if not pending: return
+        p_times = np.array([p[0] for p in pending], dtype="datetime64[us]")
+        p_codes = np.array([p[1] for p in pending], dtype=np.int32)
+        p_nodes = np.empty(len(pending), dtype=object)
+        p_nodes[:] = [p[2] for p in pending]
+        order = np.argsort(p_times, kind="stable")
+        p_times, p_codes, p_nodes = p_times[order], p_codes[order], p_nodes[order]
+        # 同一时刻的新条目排在已有条目之后
+        pos = np.searchsorted(self._times[entity_id], p_times, side="right")
+        self._times[entity_id] = np.insert(self._times[entity_id], pos, p_times)
+        self._codes[entity_id] = np.insert(self._codes[entity_id], pos, p_codes)
+        self._nodes[entity_id] = np.insert(self._nodes[entity_id], pos, p_nodes)
+
+    def _entry(self, entity_id, i):
+        return (self._times[entity_id][i].item(), self._state_names[self._codes[entity_id][i]], self._nodes[entity_id][i])
+
+    def __contains__(self, entity_id):
+        return entity_id in self._times
+
+    def entities(self):
+        return list(self._times)
+
+    def timeline(self, entity_id, since=None):
+        """[(datetime, state, node_id), ...]，按时间升序；给定 since 时从 since 之前的最后一个条目开始"""
+        if self.instr: self.instr.count("oracle_queries")
+        if entity_id not in self._times: return []
+        self._merge(entity_id)
+        start = 0
+        if since is not None:
+            start = max(int(np.searchsorted(self._times[entity_id], self._to_dt64(since), side="left")) - 1, 0)
+        return [self._entry(entity_id, i) for i in range(start, len(self._times[entity_id]))]
+
+    def items(self):
+        for entity_id in self.entities():
+            yield entity_id, self.timeline(entity_id)
+
+    def state_at(self, entity_id, times, strict=False):
+        """
+        查询实体在 t 时刻的状态：时间 <= t (strict 时为 < t) 的最后一个条目。
+        times 为单个 datetime 时返回 (dt, state, node_id) 或 None；为序列时批量查询并返回等长列表。
+        """
+        scalar = isinstance(times, datetime)
+        t_list = [times] if scalar else list(times)
+        if self.instr: self.instr.count("oracle_queries", len(t_list))
+        if entity_id in self._times:
+            self._merge(entity_id)
+            query = np.array([self._to_dt64(t) for t in t_list], dtype="datetime64[us]")
+            idx = np.searchsorted(self._times[entity_id], query, side="left" if strict else "right") - 1
+            results = [self._entry(entity_id, i) if i >= 0 else None for i in idx]
+        else:
+            results = [None] * len(t_list)
+        return results[0] if scalar else results
+
+    def next_matching(self, entity_id, state, after):
+        """按时间顺序产出 after 之后 (严格晚于) 状态等于 state 的条目"""
+        if self.instr: self.instr.count("oracle_queries")
+        code = self._state_code.get(str(state))
+        if entity_id not in self._times or code is None: return
+        self._merge(entity_id)
+        start = np.searchsorted(self._times[entity_id], self._to_dt64(after), side="right")
+        for i in np.flatnonzero(self._codes[entity_id][start:] == code) + start:
+            yield self._entry(entity_id, i)
+
+# ==========================================
+# 1.6 运行时度量 (Instrumentation)
+# ==========================================
+class EngineInstrumentation:
+    """
+    LogicEngine 的度量面板：记录每个阶段的墙钟耗时、新增节点/边数，以及阶段内的计数器增量
+    (oracle 查询、规则查找、路径搜索等)。profile=True 时为每个阶段挂上 cProfile。
+    """
+    def __init__(self, profile=False):
+        self.phases = []
+        self.counters = defaultdict(int)
+        self.profiler = cProfile.Profile() if profile else None
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    @contextmanager
+    def phase(self, name, G):
+        n0, e0 = G.number_of_nodes(), G.number_of_edges()
+        c0 = dict(self.counters)
+        if self.profiler: self.profiler.enable()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - t0
+            if self.profiler: self.profiler.disable()
+            self.phases.append({
+                "phase": name,
+                "wall_time_s": round(wall, 6),
+                "nodes_added": G.number_of_nodes() - n0,
+                "edges_added": G.number_of_edges() - e0,
+                "counters": {k: v - c0.get(k, 0) for k, v in self.counters.items() if v != c0.get(k, 0)},
+            })
+
+    def to_dict(self):
+        totals = defaultdict(float)
+        for p in self.phases:
+            totals[p["phase"]] += p["wall_time_s"]
+        return {
+            "phases": self.phases,
+            "wall_time_by_phase_s": {k: round(v, 6) for k, v in totals.items()},
+            "total_wall_time_s": round(sum(totals.values()), 6),
+            "counters": dict(self.counters),
+        }
+
+    def export_json(self, path="shadow_prov_metrics.json"):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=4)
+        print(f"[*] Engine metrics exported to {path}")
+
+    def profile_stats(self, sort="cumulative", limit=30):
+        if not self.profiler: return ""
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def dump_profile(self, path="shadow_prov_engine.prof"):
+        """导出 cProfile 原始数据，可用 snakeviz / pstats 打开"""
+        if self.profiler: self.profiler.dump_stats(path)
+
+    def report(self):
+        print("\n" + "="*50)
+        print("        [METRICS] ENGINE PHASE REPORT")
+        print("="*50)
+        for p in self.phases:
+            print(f"  {p['phase']:30} {p['wall_time_s']*1000:10.2f} ms  +{p['nodes_added']} nodes  +{p['edges_added']} edges")
+            for k, v in sorted(p["counters"].items()):
+                print(f"      - {k:26}: {v}")
+        print("="*50 + "\n")
+
 # ==========================================
 # 2. 核心逻辑引擎 (ShadowProv Logic Engine)
 # ==========================================
+# 推理超参，可通过 LogicEngine(config=...) 覆盖
+DEFAULT_ENGINE_CONFIG = {
+    "action_exists_window_seconds": 2.0,  # Formula (11) ¬Exists 检查的 Δt 窗口
+    "shadow_path_cutoff": None,           # Phase 7 影子通路的最大边数 (None 为不限，与原始搜索一致；大图可设上限换取速度)
+    "advance_window_seconds": 1000.0,     # Phase 2 Ghost -> Activity 的 shouldAdvance 窗口
+    "stream_horizon_seconds": 1200.0,     # 增量模式：滑动窗口长度 (应不小于 advance_window)，早于 watermark - horizon 的节点不再重算
+    "stream_settle_seconds": 5.0,         # 增量模式：命令发出后等待其 Generate 结果到达的时间
+}
+
+COMMAND_KINDS = ["Activity", "Command"]
+# 允许构成“影子逻辑通路”的边类型：逻辑上的推导、替换和时间对齐
+SHADOW_EDGE_TYPES = {"shouldDerive", "shouldPrecede", "sreplacedBy", "sgen"}
+# 禁区 (forbidden zone) 沿这些边向下游传播
+FORBID_PROPAGATION_TYPES = {"Generate", "wasUsedBy", "Derive", "Trigger", "sgen", "strigger"}
+
 class LogicEngine:
-    def __init__(self, graph, dsa_data, abbm_rules):
+    def __init__(self, graph, dsa_data, abbm_rules, config=None, instrumentation=None):
         self.G = graph
+        self.config = {**DEFAULT_ENGINE_CONFIG, **(config or {})}
+        self.instr = instrumentation or EngineInstrumentation()
         self.dsa_data = dsa_data
         self.abbm = abbm_rules.get("rules", abbm_rules) if isinstance(abbm_rules, dict) else abbm_rules
-        self.oracle = defaultdict(list)
+        self.oracle = StateOracle(self.instr)
         self.tainted_count = 0
+        self._rule_memo = {}
+        self._trigger_index = {}
+        self._trigger_key_of = {}      # Activity -> 所在的 trigger 索引键
+        self.forbidden_depth = {}
+        self.correction_log = []  # 各阶段新增的修正边，按产生顺序记录
+        self._cmd_index = defaultdict(lambda: ([], []))
+        self._build_rule_index()
         self._build_oracle()
+        self._build_command_index()
 
     def debug_print_oracle(self, target_eid=None):
         print("\n" + "="*30 + "\n    [DEBUG] STATE ORACLE SNAPSHOT\n" + "="*30)
@@ -91,16 +402,37 @@ class LogicEngine:
                 print(f"   {dt.strftime('%H:%M:%S.%f')[:-3]} | {state:12} | {tag} {nid}")
         print("="*30 + "\n")
 
+    def _build_rule_index(self):
+        """一次性建立 ABBM 规则索引 (id / alias / action.command -> 规则下标)，保留列表中的先后顺序"""
+        self._rule_by_id, self._rule_by_alias, self._rule_by_command = {}, {}, {}
+        for idx, r in enumerate(self.abbm):
+            self._rule_by_id.setdefault(str(r.get("id")), idx)
+            self._rule_by_alias.setdefault(r.get("alias"), idx)
+            self._rule_by_command.setdefault(r.get("action", {}).get("command"), idx)
+
     def _get_rule_for_activity(self, nid):
+        self.instr.count("rule_lookups")
+        if nid in self._rule_memo:
+            self.instr.count("rule_memo_hits")
+            return self._rule_memo[nid]
         node_data = self.G.nodes[nid]
+        rule = None
         agent_nodes = [s for s, t, d in self.G.in_edges(nid, data=True) if d.get("type") == "wasAssociateWith"]
         for agent_id in agent_nodes:
             agent_data = self.G.nodes[agent_id]
             auto_id = node_data.get("automation_id") or agent_data.get("automation_id")
-            device_name = agent_data.get("device")
-            rule = next((r for r in self.abbm if (auto_id and str(r.get("id")) == str(auto_id)) or (r.get("alias") == device_name)), None)
-            if rule: return rule
-        return next((r for r in self.abbm if r.get("action", {}).get("command") == node_data.get("command")), None)
+            # 与线性扫描等价：取 id 命中与 alias 命中中排在规则列表最前的一条
+            hits = [self._rule_by_alias.get(agent_data.get("device"))]
+            if auto_id: hits.append(self._rule_by_id.get(str(auto_id)))
+            hits = [i for i in hits if i is not None]
+            if hits:
+                rule = self.abbm[min(hits)]
+                break
+        if rule is None:
+            idx = self._rule_by_command.get(node_data.get("command"))
+            rule = self.abbm[idx] if idx is not None else None
+        self._rule_memo[nid] = rule
+        return rule
 
     def _build_oracle(self):
         print("[*] Building State Oracle...")
@@ -108,25 +440,63 @@ class LogicEngine:
             if d.get("kind") in ["Entity", "GhostEntity"] and "entity_id" in d:
                 dt = parse_dt(d.get("_dt"))
                 state = d.get("new_state") or d.get("state")
-                bisect.insort(self.oracle[d["entity_id"]], (dt, state, n))
+                self.oracle.insert(d["entity_id"], dt, state, n)
+
+    def _build_command_index(self):
+        """command -> 按时间排序的 (时间轴, 节点) 索引，_dt 只解析一次"""
+        for n, d in self.G.nodes(data=True):
+            if d.get("kind") in COMMAND_KINDS + ["TaintedCommand"] and d.get("command"):
+                self._index_command(n, d["command"], parse_dt(d.get("_dt")))
+
+    def _index_command(self, nid, command, dt):
+        times, nodes = self._cmd_index[command]
+        idx = bisect.bisect_right(times, dt)
+        times.insert(idx, dt)
+        nodes.insert(idx, nid)
+
+    def command_exists_between(self, command, start, end, include_tainted=False):
+        """[start, end] 内是否执行过 command；默认只认真实 Activity/Command，不认 Tainted 推断节点"""
+        self.instr.count("command_index_queries")
+        if command not in self._cmd_index: return False
+        times, nodes = self._cmd_index[command]
+        lo, hi = bisect.bisect_left(times, start), bisect.bisect_right(times, end)
+        if include_tainted: return hi > lo
+        return any(self.G.nodes[n].get("kind") in COMMAND_KINDS for n in nodes[lo:hi])
 
     def query_oracle_timeline(self, entity_id):
-        return self.oracle.get(entity_id, [])
+        return self.oracle.timeline(entity_id)
+
+    def query_forbidden_zone(self):
+        """禁区节点 -> 距最近 sforbid 种子的传播深度 (由 Phase 8 计算)"""
+        return dict(self.forbidden_depth)
 
     def _get_effect_from_rule(self, rule):
         return rule.get("effect") or rule.get("consequence") or {}
 
+    def _add_correction_edge(self, u, v, etype, label=None):
+        """写入一条推理修正边；只有新边 (或类型改变的边) 才记入 correction_log"""
+        label = label or etype
+        prev = self.G.get_edge_data(u, v)
+        prev_type = prev.get("type") if prev is not None else None
+        self.G.add_edge(u, v, label=label, type=etype)
+        if prev is None or prev_type != etype:
+            self.instr.count("correction_edges")
+            self.correction_log.append({"source": u, "target": v, "type": etype, "label": label})
+
     # === Phase 1: Manifestation ===
-    def phase_1_manifestation(self):
+    def phase_1_manifestation(self, items=None):
+        """返回本次新生成的 Ghost 节点；items 默认为全部 DSA 原语"""
         print("\n[Phase 1] Manifesting Shadow Nodes (Ghosts & Zombies)...")
-        for item in self.dsa_data:
+        new_ghosts = []
+        for item in (self.dsa_data if items is None else items):
             p_type, nid, meta = item.get("type"), item.get("node_id", ""), item.get("metadata", {})
             ts = parse_dt(item.get("timestamp"))
             if p_type == "UNCLAIMED":
                 ghost_id = f"Ghost_I_{item.get('physical_id', nid)}"
                 eid, state = meta.get('entity_id'), meta.get('state')
                 self.G.add_node(ghost_id, label=f"Ghost Entity\n{eid}\n{state}", kind="GhostEntity", sub_kind="Ghost-I", entity_id=eid, new_state=state, _dt=ts, timestamp=ts.isoformat())
-                bisect.insort(self.oracle[eid], (ts, state, ghost_id))
+                self.oracle.insert(eid, ts, state, ghost_id)
+                new_ghosts.append(ghost_id)
             elif p_type == "UNSUPPORTED" and nid in self.G:
                 node_data = self.G.nodes[nid]
                 if node_data.get("kind") == "Entity":
@@ -140,16 +510,76 @@ class LogicEngine:
                         base_dt = node_data.get("_dt") or ts
                         g2_ts = base_dt + timedelta(milliseconds=150)
                         self.G.add_node(ghost_ii_id, label=f"Ghost Entity (II)\n{eff['entity_id']}\n{eff['state']}", kind="GhostEntity", sub_kind="Ghost-II", base_kind="Entity", entity_id=eff['entity_id'], state=eff['state'], new_state=eff['state'], _dt=g2_ts, timestamp=g2_ts.isoformat())
-                        self.G.add_edge(nid, ghost_ii_id, label="sgen", type="sgen")
-                        bisect.insort(self.oracle[eff['entity_id']], (g2_ts, eff['state'], ghost_ii_id))
+                        self._add_correction_edge(nid, ghost_ii_id, "sgen")
+                        self.oracle.insert(eff['entity_id'], g2_ts, eff['state'], ghost_ii_id)
+                        new_ghosts.append(ghost_ii_id)
                         print(f"  [+] Ghost-II Fixed: {eff['entity_id']} recovered as {eff['state']}")
+        return new_ghosts
+
+    def _trigger_key(self, act_id):
+        act_data = self.G.nodes[act_id]
+        if act_data.get("kind") not in ["Activity", "Command"] or act_data.get("is_zombie"):
+            return None
+        rule = self._get_rule_for_activity(act_id)
+        if not rule: return None
+        trigger_cfg = rule.get("trigger", {})
+        return (str(trigger_cfg.get("entity_id")), str(trigger_cfg.get("to")))
+
+    def _build_trigger_index(self):
+        """(trigger entity_id, trigger state) -> 按时间排序的 Activity 时间轴，供 Phase 2 区间查询"""
+        buckets = defaultdict(list)
+        for act_id, act_data in self.G.nodes(data=True):
+            key = self._trigger_key(act_id)
+            if key: buckets[key].append((parse_dt(act_data.get("_dt")), act_id))
+
+        self._trigger_index = {}
+        self._trigger_key_of = {}
+        for key, acts in buckets.items():
+            for _, act_id in acts: self._trigger_key_of[act_id] = key
+            acts.sort(key=lambda x: x[0])
+            self._trigger_index[key] = ([t for t, _ in acts], [a for _, a in acts])
+
+    def _index_trigger_activity(self, act_id):
+        """增量模式下把单个新 Activity 插入 trigger 索引"""
+        key = self._trigger_key(act_id)
+        if not key: return
+        times, acts = self._trigger_index.setdefault(key, ([], []))
+        dt = parse_dt(self.G.nodes[act_id].get("_dt"))
+        idx = bisect.bisect_right(times, dt)
+        times.insert(idx, dt)
+        acts.insert(idx, act_id)
+        self._trigger_key_of[act_id] = key
+
+    def _reindex_trigger_activity(self, act_id):
+        """Activity 的规则可能变化 (迟到的 wasAssociateWith 边)：从旧的 trigger 条目中移除后重新索引"""
+        self._rule_memo.pop(act_id, None)
+        old_key = self._trigger_key_of.pop(act_id, None)
+        if old_key is not None:
+            times, acts = self._trigger_index[old_key]
+            i = acts.index(act_id)
+            del times[i], acts[i]
+        self._index_trigger_activity(act_id)
+        if old_key is None or self._trigger_key_of.get(act_id) == old_key: return
+        # 按旧规则建立的 shouldAdvance 不再成立：从图中移除，并在修正流中记一条撤回
+        for g_id, _, d in list(self.G.in_edges(act_id, data=True)):
+            g_data = self.G.nodes[g_id]
+            if d.get("type") == "shouldAdvance" and (str(g_data.get("entity_id")), str(g_data.get("new_state") or g_data.get("state"))) == old_key:
+                self.G.remove_edge(g_id, act_id)
+                self.correction_log.append({"source": g_id, "target": act_id, "type": "retracted", "label": "retracted (shouldAdvance)"})
+
+    def _ghost_nodes(self):
+        return [n for n, d in self.G.nodes(data=True) if d.get("kind") == "GhostEntity"]
 
     # === 优化后的 Phase 2: Control Race ===
-    def phase_2_control_race(self):
+    def phase_2_control_race(self, ghosts=None):
         print("\n[Phase 2] Generating shouldAdvance (Logic-based)...")
-        ghost_nodes = [n for n, d in self.G.nodes(data=True) if d.get("kind") == "GhostEntity"]
+        # 批处理时重建 trigger 索引；增量模式下索引由 _index_trigger_activity 维护
+        if ghosts is None:
+            ghosts = self._ghost_nodes()
+            self._build_trigger_index()
+        window = timedelta(seconds=self.config["advance_window_seconds"])
 
-        for g_id in ghost_nodes:
+        for g_id in ghosts:
             g_data = self.G.nodes[g_id]
             eid = g_data.get("entity_id")
             g_state = str(g_data.get("new_state") or g_data.get("state"))
@@ -157,58 +587,35 @@ class LogicEngine:
 
             # 策略：寻找在 Ghost 之后发生的、且业务逻辑上依赖该 Entity 的 Activity
             # 这样即使原始图中没有 wasUsedBy 边，我们也能通过 ABBM 规则建立逻辑关联
-            for act_id, act_data in self.G.nodes(data=True):
-                if act_data.get("kind") not in ["Activity", "Command"] or act_data.get("is_zombie"):
-                    continue
-                
-                # 检查该 Activity 是否在逻辑上需要这个实体 (通过 ABBM 规则)
-                rule = self._get_rule_for_activity(act_id)
-                if not rule: continue
+            # 索引键即 "Ghost 节点就是这个 Command 梦寐以求的那个触发信号"
+            times, acts = self._trigger_index.get((str(eid), g_state), ([], []))
+            self.instr.count("trigger_index_queries")
 
-                trigger_cfg = rule.get("trigger", {})
-                t_eid = trigger_cfg.get("entity_id")
-                t_state = str(trigger_cfg.get("to"))
+            # 只要物理 Command 发生在 Ghost 之后（考虑延迟，窗口给大一点）
+            # 建立 shouldAdvance，表示逻辑上的驱动关系
+            lo = bisect.bisect_left(times, g_time)
+            hi = bisect.bisect_right(times, g_time + window)
+            for act_id in acts[lo:hi]:
+                if not self.G.has_edge(g_id, act_id):
+                    self._add_correction_edge(g_id, act_id, "shouldAdvance")
+                    print(f"  [+] shouldAdvance: {g_id} (Logic Trigger) -->> {act_id} (Physical Cmd)")
 
-                # 核心逻辑：如果 Ghost 节点就是这个 Command 梦寐以求的那个触发信号
-                if str(eid) == str(t_eid) and g_state == t_state:
-                    act_time = parse_dt(act_data.get("_dt"))
-                    
-                    # 只要物理 Command 发生在 Ghost 之后（考虑延迟，窗口给大一点）
-                    # 建立 shouldAdvance，表示逻辑上的驱动关系
-                    if g_time <= act_time <= g_time + timedelta(seconds=1000):
-                        print("should Advance")
-                        print(g_id)
-                        print(act_id)
-                        
-                        if not self.G.has_edge(g_id, act_id):
-                            self.G.add_edge(g_id, act_id, label="shouldAdvance", type="shouldAdvance")
-                            print(f"  [+] shouldAdvance: {g_id} (Logic Trigger) -->> {act_id} (Physical Cmd)")
-
-
-
-    def phase_3_temporal(self):
+    def phase_3_temporal(self, ghosts=None):
         print("\n[Phase 3] Checking Temporal Latency (shouldPrecede: Ghost -> Nearest Clean Entity)...")
-        ghost_nodes = [n for n, d in self.G.nodes(data=True) if d.get("kind") == "GhostEntity"]
-        
-        for g_id in ghost_nodes:
+        for g_id in (self._ghost_nodes() if ghosts is None else ghosts):
             g_data = self.G.nodes[g_id]
             g_time, eid, g_state = g_data.get("_dt"), g_data.get("entity_id"), str(g_data.get("new_state"))
             
-            timeline = self.query_oracle_timeline(eid)
-            idx = bisect.bisect_right(timeline, (g_time, "~~~~", "~~~~"))
-            
-            for i in range(idx, len(timeline)):
-                l_time, l_state, l_node = timeline[i]
-                
+            for l_time, l_state, l_node in self.oracle.next_matching(eid, g_state, g_time):
                 # 核心互斥检查：
                 # 1. 必须是真实节点
-                # 2. 状态一致
+                # 2. 状态一致 (由 next_matching 保证)
                 # 3. ！！！该节点不能在禁区内 (in_forbidden_zone) ！！！
                 #    如果在禁区内，它将被 Phase 8 的 replacedBy 处理，而不是 shouldPrecede
-                if "Ghost" not in str(l_node) and str(l_state) == g_state:
+                if "Ghost" not in str(l_node):
                     if not self.G.nodes[l_node].get("in_forbidden_zone", False):
                         lag = (l_time - g_time).total_seconds()
-                        self.G.add_edge(g_id, l_node, label=f"shouldPrecede\n({lag:.2f}s)", type="shouldPrecede")
+                        self._add_correction_edge(g_id, l_node, "shouldPrecede", f"shouldPrecede\n({lag:.2f}s)")
                         print(f"  [+] shouldPrecede (Clean): {g_id} -> {l_node}")
                         break
                     else:
@@ -217,11 +624,9 @@ class LogicEngine:
 
 
     # === Phase 4: Counterfactual Inference ===
-    def phase_4_inference(self):
+    def phase_4_inference(self, ghosts=None):
         print("\n[Phase 4] Generating Tainted Subgraphs (Counterfactual)...")
-        ghost_nodes = [n for n, d in self.G.nodes(data=True) if d.get("kind") == "GhostEntity"]
-        
-        for g_id in ghost_nodes:
+        for g_id in (self._ghost_nodes() if ghosts is None else ghosts):
             # 如果 Ghost 已经重新归因给了现存的真实 Activity (Rule 2)，则不应触发 Rule 3
             if any(edge_attr.get('type') == 'shouldAdvance' for _, _, edge_attr in self.G.edges(g_id, data=True)):
                 continue
@@ -242,10 +647,9 @@ class LogicEngine:
                     # 1. 检查 Context / Preconditions 是否满足
                     if rule.get("condition"):
                         cond = rule["condition"]
-                        timeline = self.query_oracle_timeline(cond.get("entity_id"))
-                        idx = bisect.bisect_right(timeline, (g_time, "~~~~", "~~~~"))
-                        if idx > 0:
-                            act_st, _, ctx_node = timeline[idx-1]
+                        hit = self.oracle.state_at(cond.get("entity_id"), g_time)
+                        if hit:
+                            _, act_st, ctx_node = hit
                             if str(act_st) != str(cond.get("state")): 
                                 should_run = False
                         else: 
@@ -255,18 +659,10 @@ class LogicEngine:
                     if should_run:
                         action_cmd = rule.get("action", {}).get("command")
                         # 检查在 g_time 之后的 [0, Δt] 窗口内，系统是否已经执行了该命令？
-                        delta_t = timedelta(seconds=2.0) # 假设时间窗口为2秒，可根据配置读取
-                        action_exists = False
-                        
-                        # 遍历图中的命令节点，查找是否有真实执行记录
-                        for n, d in self.G.nodes(data=True):
-                            if d.get("kind") in ["Activity", "Command"] and d.get("command") == action_cmd:
-                                cmd_time = parse_dt(d.get("_dt"))
-                                if g_time <= cmd_time <= g_time + delta_t:
-                                    # 如果在有效窗口内找到了真实的命令，说明动作发生了，不需要脑补(Counterfactual)
-                                    action_exists = True
-                                    break
-                        
+                        # 如果在有效窗口内找到了真实的命令，说明动作发生了，不需要脑补(Counterfactual)
+                        delta_t = timedelta(seconds=self.config["action_exists_window_seconds"])
+                        action_exists = self.command_exists_between(action_cmd, g_time, g_time + delta_t)
+
                         # 只有在条件满足，且系统实际上没有执行该动作时，才推断 Tainted Graph
                         if not action_exists:
                             self._inject_tainted_subgraph(g_id, rule, g_time, ctx_node)
@@ -288,51 +684,66 @@ class LogicEngine:
         
         cmd_id = f"TaintedCmd_{act['command']}{suffix}"
         self.G.add_node(cmd_id, label=f"Tainted Cmd\n{act['command']}\n(@{cmd_dt.strftime('%H:%M:%S')})", kind="TaintedCommand", command=act['command'], _dt=cmd_dt.isoformat(), timestamp=cmd_dt.isoformat())
-        self.G.add_edge(trigger_id, cmd_id, label="shouldTrigger", type="shouldTrigger")
-        if ctx_node: self.G.add_edge(ctx_node, cmd_id, label="inform", type="inform")
+        self._index_command(cmd_id, act['command'], cmd_dt)
+        self._add_correction_edge(trigger_id, cmd_id, "shouldTrigger")
+        if ctx_node: self._add_correction_edge(ctx_node, cmd_id, "inform")
         
         res_id = f"TaintedRes_{eff['entity_id']}{suffix}"
         self.G.add_node(res_id, label=f"Tainted Entity\n{eff['state']}\n[{eff['semantic_label']}]", kind="TaintedEntity", entity_id=eff['entity_id'], new_state=eff['state'], _dt=res_dt.isoformat(), timestamp=res_dt.isoformat())
-        self.G.add_edge(cmd_id, res_id, label="sgen", type="sgen")
+        self._add_correction_edge(cmd_id, res_id, "sgen")
 
     # === Phase 5: Validity (sforbid) ===
-    def phase_5_validity(self):
+    def phase_5_validity(self, activities=None):
         print("\n[Phase 5] Detecting Interjections (sforbid)...")
-        for n, d in self.G.nodes(data=True):
+        queries = defaultdict(list)  # 条件实体 -> [(activity, cond, cmd_time)]
+        nodes = self.G.nodes(data=True) if activities is None else ((n, self.G.nodes[n]) for n in activities)
+        for n, d in nodes:
             if d.get("kind") == "Activity" and not d.get("is_zombie"):
                 rule = self._get_rule_for_activity(n)
                 if not rule: continue
                 cmd_time = parse_dt(d.get("_dt"))
                 for cond in rule.get("conditions", []):
-                    timeline = self.query_oracle_timeline(cond.get("entity_id"))
-                    idx = bisect.bisect_right(timeline, (cmd_time, "~~~~", "~~~~"))
-                    if idx > 0 and str(timeline[idx-1][1]) != str(cond.get("state")):
-                        if "Ghost" in str(timeline[idx-1][2]):
-                            self.G.add_edge(timeline[idx-1][2], n, label=f"sforbid\n(Reality:{timeline[idx-1][1]})", type="sforbid")
+                    queries[cond.get("entity_id")].append((n, cond, cmd_time))
+
+        # 同一条件实体的所有命令时刻一次性批量查询
+        for cond_eid, items in queries.items():
+            hits = self.oracle.state_at(cond_eid, [t for _, _, t in items])
+            for (n, cond, _), hit in zip(items, hits):
+                if hit and str(hit[1]) != str(cond.get("state")) and "Ghost" in str(hit[2]):
+                    self._add_correction_edge(hit[2], n, "sforbid", f"sforbid\n(Reality:{hit[1]})")
 
     # === NEW: Identify Forbidden Cascade ===
-    def _identify_forbidden_cascade(self):
-        """递归识别受攻击污染的全路径禁区"""
-        forbidden_zone = set()
-        seeds = [v for u, v, d in self.G.edges(data=True) if d.get("type") == "sforbid"]
-        forbidden_zone.update(seeds)
-
-        changed = True
-        while changed:
-            changed = False
-            current_len = len(forbidden_zone)
-            for u, v, d in self.G.edges(data=True):
-                if u in forbidden_zone and v not in forbidden_zone:
-                    et = d.get("type")
-                    if et in ["Generate", "wasUsedBy", "Derive", "Trigger", "sgen", "strigger"]:
-                        print("forbidden zone")
-                        print(v)
-                        forbidden_zone.add(v)
-            if len(forbidden_zone) > current_len: changed = True
-        
-        
+    def _identify_forbidden_cascade(self, seeds=None, frontier=()):
+        """
+        递归识别受攻击污染的全路径禁区 (BFS 工作表，每条边至多访问一次)。
+        seeds 为 None 时从全部 sforbid 目标重新计算；否则在现有禁区上增量扩展：
+        seeds 作为新的 0 层种子，frontier 为出边有新增的已有禁区节点。
+        """
+        if seeds is None:
+            seeds = [v for u, v, d in self.G.edges(data=True) if d.get("type") == "sforbid"]
+            self.forbidden_depth = {}
+        depth = self.forbidden_depth
+        known = set(depth)
+        worklist = deque()
+        for nid in seeds:
+            if depth.get(nid) != 0:
+                depth[nid] = 0
+                worklist.append(nid)
+        worklist.extend(n for n in frontier if n in depth)
+        while worklist:
+            u = worklist.popleft()
+            for _, v, d in self.G.out_edges(u, data=True):
+                if d.get("type") in FORBID_PROPAGATION_TYPES and (v not in depth or depth[v] > depth[u] + 1):
+                    depth[v] = depth[u] + 1
+                    worklist.append(v)
+
+        forbidden_zone = set(depth)
+        new_nodes = forbidden_zone - known
+        if new_nodes:
+            print(f"  [*] Forbidden zone: +{len(new_nodes)} nodes from {len(set(seeds))} sforbid seeds (max depth {max(depth.values())})")
+
         #染色逻辑
-        for nid in forbidden_zone:
+        for nid in new_nodes:
             self.G.nodes[nid]["in_forbidden_zone"] = True
             # 可选：修改 label 方便可视化调试
             if "[FORBIDDEN]" not in self.G.nodes[nid].get("label", ""):
@@ -341,12 +752,15 @@ class LogicEngine:
         return forbidden_zone
 
     # === 修正后的 Phase 8: 状态替换逻辑 ===
-    def phase_8_restorative_sgen(self):
+    def phase_8_restorative_sgen(self, commands=None, seeds=None, frontier=()):
+        """返回本次恢复出的 Ghost 节点；commands / seeds / frontier 供增量模式限定范围"""
         print("\n[Phase 8] Restoring Silenced Commands (Causal Replacement)...")
-        forbidden_zone = self._identify_forbidden_cascade()
-        all_cmds = [n for n, d in self.G.nodes(data=True) if d.get("kind") in ["Activity", "Command"]]
-        
-        for cmd_id in all_cmds:
+        forbidden_zone = self._identify_forbidden_cascade(seeds, frontier)
+        if commands is None:
+            commands = [n for n, d in self.G.nodes(data=True) if d.get("kind") in ["Activity", "Command"]]
+        new_ghosts = []
+
+        for cmd_id in commands:
             cmd_data = self.G.nodes[cmd_id]
             if cmd_id in forbidden_zone or cmd_data.get("is_zombie"): continue
 
@@ -362,14 +776,11 @@ class LogicEngine:
                 
                 # 在时间线上寻找被“顶替”的脏节点
                 cmd_dt = parse_dt(cmd_data.get("_dt"))
-                timeline = self.query_oracle_timeline(target_eid)
-                idx = bisect.bisect_left(timeline, (cmd_dt, "", ""))
 
                 # --- 1. 往前找：寻找逻辑起点 A(ON) ---
-                # idx-1 是时间轴上紧挨着命令之前的节点
-                prev_node = None
-                if idx > 0:
-                    _, _, prev_node = timeline[idx-1]
+                # 时间轴上严格早于命令、紧挨着命令之前的节点
+                hit = self.oracle.state_at(target_eid, cmd_dt, strict=True)
+                prev_node = hit[2] if hit else None
 
                 # --- 3. 建立修复边 ---
                 if prev_node:
@@ -380,23 +791,26 @@ class LogicEngine:
                                     kind="GhostEntity", entity_id=target_eid, new_state=target_state, 
                                     _dt=g_dt, timestamp=g_dt.isoformat())
                     
-                    self.G.add_edge(prev_node, ghost_id, label="sreplacedBy", type="sreplacedBy")
+                    self._add_correction_edge(prev_node, ghost_id, "sreplacedBy")
                     
                     # Command --sgen--> Ghost
-                    self.G.add_edge(cmd_id, ghost_id, label="sgen", type="sgen")
+                    self._add_correction_edge(cmd_id, ghost_id, "sgen")
 
-                    
-                    bisect.insort(self.oracle[target_eid], (g_dt, target_state, ghost_id))
+                    self.oracle.insert(target_eid, g_dt, target_state, ghost_id)
+                    new_ghosts.append(ghost_id)
+        return new_ghosts
 
 
     # === Phase 6: Lineage ===
-    def phase_6_lineage(self):
+    def phase_6_lineage(self, entities=None, since=None):
+        """entities / since 供增量模式只缝合指定实体在 since 之后的时间轴"""
         print("\n[Phase 6] Stitching state evolution...")
-        for eid, timeline in self.oracle.items():
-            sorted_tl = sorted(timeline, key=lambda x: x[0])
-            for i in range(len(sorted_tl) - 1):
-                curr_dt, curr_s, curr_node = sorted_tl[i]
-                next_dt, next_s, next_node = sorted_tl[i+1]
+        for eid in (self.oracle.entities() if entities is None else entities):
+            # oracle 时间轴本身已按时间排序
+            timeline = self.oracle.timeline(eid, since)
+            for i in range(len(timeline) - 1):
+                curr_dt, curr_s, curr_node = timeline[i]
+                next_dt, next_s, next_node = timeline[i+1]
                 
                 # 防护 A: 如果已经有 replacedBy 关系，严禁再加演化边
                 if self.G.has_edge(next_node, curr_node) and self.G[next_node][curr_node].get("type") == "replacedBy":
@@ -406,80 +820,230 @@ class LogicEngine:
                     if str(curr_s) != str(next_s):
                         # 只有在没有被 replacedBy 的情况下才加推演
                         if not self.G.has_edge(curr_node, next_node):
-                            self.G.add_edge(curr_node, next_node, label="shouldDerive", type="shouldDerive")
+                            self._add_correction_edge(curr_node, next_node, "shouldDerive")
                     else:
                         # 相同状态走对齐
                         if not self.G.has_edge(curr_node, next_node):
-                            self.G.add_edge(curr_node, next_node, label="shouldPrecede", type="shouldPrecede")
+                            self._add_correction_edge(curr_node, next_node, "shouldPrecede")
+
     # === Phase 7: Conflict Resolution ===
+    def _is_ghost(self, nid):
+        return "Ghost" in str(nid) or self.G.nodes[nid].get("kind") == "GhostEntity"
+
+    def _shadow_view(self):
+        """只读视图：仅保留 SHADOW_EDGE_TYPES 边，搜索期间不再改动原图"""
+        return nx.subgraph_view(self.G, filter_edge=lambda u, v: self.G[u][v].get("type") in SHADOW_EDGE_TYPES)
+
+    def _ghost_reach(self, view, cutoff, ghosts=None):
+        """返回 (能到达某个 Ghost 的节点, 能被某个 Ghost 到达的节点)，两者都包含 Ghost 本身"""
+        if ghosts is None: ghosts = [n for n in view if self._is_ghost(n)]
+        if not ghosts: return set(), set()
+        reachable = nx.multi_source_dijkstra_path_length(view, ghosts, cutoff=cutoff)
+        ancestors = nx.multi_source_dijkstra_path_length(nx.reverse_view(view), ghosts, cutoff=cutoff)
+        return set(ancestors), set(reachable)
+
     # === 优化后的 Phase 7: Conflict Resolution ===
-    def phase_7_conflict_resolution(self):
+    def phase_7_conflict_resolution(self, derives=None, ghosts=None):
+        """derives / ghosts 供增量模式限定待检查的 Derive 边与参与搜索的 Ghost"""
         print("\n[Phase 7] Suppressing legacy edges (Strict Shadow Path Reduction)...")
         edges_to_suppress = []
-
-        # 定义允许构成“影子逻辑通路”的边类型
-        # 这些边代表了逻辑上的推导、替换和时间对齐
-        SHADOW_EDGE_TYPES = {"shouldDerive", "shouldPrecede", "sreplacedBy", "sgen"}
+        cutoff = self.config["shadow_path_cutoff"]
 
         # 获取所有原始的物理推导边
-        physical_derives = [(u, v) for u, v, d in self.G.edges(data=True) if d.get("type") == "Derive"]
+        if derives is None:
+            physical_derives = [(u, v) for u, v, d in self.G.edges(data=True) if d.get("type") == "Derive"]
+        else:
+            physical_derives = [(u, v) for u, v in derives if self.G.get_edge_data(u, v, {}).get("type") == "Derive"]
+        if not physical_derives: return
+
+        # 影子通路上的每一条边都必须属于 SHADOW_EDGE_TYPES，Derive 本身不在其中，无需临时删边
+        shadow = self._shadow_view()
+        to_ghost, from_ghost = self._ghost_reach(shadow, cutoff, ghosts)
+        # 含 Ghost 的通路上，Ghost 之前的节点都在 to_ghost 中，之后的都在 from_ghost 中
+        search_space = shadow.subgraph(to_ghost | from_ghost)
 
         for u, v in physical_derives:
-            # 临时移除物理边以寻找替代的逻辑路径
-            edge_data = self.G.get_edge_data(u, v)
-            self.G.remove_edge(u, v)
-            
-            try:
-                # 寻找从 u 到 v 的所有简单路径
-                for path in nx.all_simple_paths(self.G, source=u, target=v):
-                    # 验证路径属性：
-                    # 1. 路径中必须包含至少一个 Ghost 节点
-                    # 2. 路径上的每一条边都必须属于 SHADOW_EDGE_TYPES
-                    
-                    has_ghost = any("Ghost" in str(node) or self.G.nodes[node].get("kind") == "GhostEntity" 
-                                    for node in path)
-                    
-                    if not has_ghost:
-                        continue
-
-                    # 检查路径上的所有边是否都是逻辑边
-                    all_logical_edges = True
-                    for i in range(len(path) - 1):
-                        curr_edge_type = self.G[path[i]][path[i+1]].get("type")
-                        if curr_edge_type not in SHADOW_EDGE_TYPES:
-                            all_logical_edges = False
-                            break
-                    
-                    if all_logical_edges:
-                        edges_to_suppress.append((u, v))
-                        path_str = " -> ".join([str(n) for n in path])
-                        print(f"  [-] Suppression: {u}->{v} replaced by Shadow Path [{path_str}]")
-                        break
-            except nx.NetworkXNoPath:
-                pass
-            finally:
-                # 恢复边，后续统一标记
-                self.G.add_edge(u, v, **edge_data)
+            # 预检查：u 到不了任何 Ghost，或 v 不可能由 Ghost 推出，则必无合法影子通路
+            if u not in to_ghost or v not in from_ghost:
+                self.instr.count("path_prechecks_rejected")
+                continue
+
+            self.instr.count("path_searches")
+            for path in nx.all_simple_paths(search_space, source=u, target=v, cutoff=cutoff):
+                # 路径中必须包含至少一个 Ghost 节点
+                if any(self._is_ghost(node) for node in path):
+                    edges_to_suppress.append((u, v))
+                    path_str = " -> ".join([str(n) for n in path])
+                    print(f"  [-] Suppression: {u}->{v} replaced by Shadow Path [{path_str}]")
+                    break
 
         # 执行抑制标记
         for u, v in edges_to_suppress:
-            self.G[u][v]["type"] = "suppressed"
-            self.G[u][v]["label"] = "[SUPPRESSED] (Causal Correction)"
+            self._add_correction_edge(u, v, "suppressed", "[SUPPRESSED] (Causal Correction)")
+
+    def _run_phase(self, phase, *args, **kwargs):
+        with self.instr.phase(phase.__name__, self.G):
+            return phase(*args, **kwargs)
 
-    
     def run(self):
         # 严格按照全生命周期流转
-        self.phase_1_manifestation()
+        self._run_phase(self.phase_1_manifestation)
         
-        self.phase_5_validity()
-        self.phase_8_restorative_sgen()
-        self.phase_3_temporal()
-        self.phase_2_control_race() 
-        self.phase_4_inference()
-        self.phase_6_lineage()
-        self.phase_7_conflict_resolution()
+        self._run_phase(self.phase_5_validity)
+        self._run_phase(self.phase_8_restorative_sgen)
+        self._run_phase(self.phase_3_temporal)
+        self._run_phase(self.phase_2_control_race)
+        self._run_phase(self.phase_4_inference)
+        self._run_phase(self.phase_6_lineage)
+        self._run_phase(self.phase_7_conflict_resolution)
         return self.G
 
+class StreamingLogicEngine(LogicEngine):
+    """
+    增量 (流式) 模式：按时间顺序接收 G6 节点/边与 DSA 原语，每次 flush 只对新节点以及
+    [watermark - horizon, watermark] 滑动窗口内的节点重跑受影响的阶段，并返回新增的修正边。
+    需要等窗口关闭才能下结论的推理会延后：Phase 4 的反事实推断等 Ghost 的 shouldAdvance 窗口关闭，
+    Phase 8 的沉默命令恢复等命令的 Generate 结果到达 (stream_settle_seconds)。
+    """
+    def __init__(self, abbm_rules, config=None, instrumentation=None):
+        super().__init__(nx.DiGraph(), [], abbm_rules, config, instrumentation)
+        self.watermark = None          # 由第一个时间戳确定 (可能带时区)
+        self._emitted = 0
+        self._pending_items = []       # 尚未处理 (或引用的节点尚未到达) 的 DSA 原语
+        self._new_activities = []
+        self._dirty_entities = set()   # 时间轴有新条目、需要重新缝合的实体
+        self._forbid_frontier = set()  # 出边有新增的禁区节点
+        self._live_ghosts = {}         # 窗口内的 Ghost -> dt
+        self._live_activities = {}     # 窗口内的 Activity -> dt
+        self._live_derives = {}        # 窗口内的物理 Derive 边 -> dt
+        self._unsettled_ghosts = {}    # 等待 Phase 4 结论的 Ghost
+        self._unsettled_commands = {}  # 等待 Phase 8 结论的命令
+        self._parked_derives = defaultdict(list)  # 目标节点尚未到达的 Derive 边：目标 -> [源]
+
+    def _bound(self, dt):
+        """datetime.min / max 哨兵，与 watermark 的时区感知保持一致 (aware 与 naive 不能比较)"""
+        return dt.replace(tzinfo=timezone.utc) if self.watermark is not None and self.watermark.tzinfo else dt
+
+    def _advance_watermark(self, dt):
+        if dt is None or dt == datetime.min: return  # 无法解析的时间戳不推进 watermark
+        self.watermark = dt if self.watermark is None else max(self.watermark, dt)
+
+    def _before_watermark(self, seconds):
+        if self.watermark is None: return self._bound(datetime.min)
+        try:
+            return self.watermark - timedelta(seconds=seconds)
+        except OverflowError:
+            return self._bound(datetime.min)
+
+    def _track_ghost(self, g_id):
+        g_data = self.G.nodes[g_id]
+        dt = parse_dt(g_data.get("_dt"))
+        self._live_ghosts[g_id] = self._unsettled_ghosts[g_id] = dt
+        self._dirty_entities.add(g_data.get("entity_id"))
+
+    def push_nodes(self, nodes, links=()):
+        """接收 G6 格式 (load_g6_graph 的输入格式) 的新节点与新边"""
+        for node in nodes:
+            node_id, attrs = _g6_node(node)
+            self.G.add_node(node_id, **attrs)
+            self._advance_watermark(attrs["_dt"])
+            for u in self._parked_derives.pop(node_id, ()):
+                if self.G.get_edge_data(u, node_id, {}).get("type") == "Derive": self._live_derives[(u, node_id)] = attrs["_dt"]
+            kind = attrs.get("kind")
+            if kind in ["Entity", "GhostEntity"] and "entity_id" in attrs:
+                self.oracle.insert(attrs["entity_id"], attrs["_dt"], attrs.get("new_state") or attrs.get("state"), node_id)
+                self._dirty_entities.add(attrs["entity_id"])
+                if kind == "GhostEntity": self._track_ghost(node_id)
+            elif kind in COMMAND_KINDS:
+                if attrs.get("command"): self._index_command(node_id, attrs["command"], attrs["_dt"])
+                self._new_activities.append(node_id)
+
+        for edge in links:
+            u, v, attrs = _g6_edge(edge)
+            self.G.add_edge(u, v, **attrs)
+            if attrs["type"] == "wasAssociateWith":
+                # 已 flush 过的 Activity 需要按新规则重新索引；尚未 flush 的在 flush 时按新规则索引
+                if v not in self._new_activities: self._reindex_trigger_activity(v)
+                else: self._rule_memo.pop(v, None)
+            elif attrs["type"] == "Derive":
+                # 目标节点尚未到达时先挂起，等节点到达再按其时间戳加入窗口
+                if "_dt" in self.G.nodes[v]: self._live_derives[(u, v)] = parse_dt(self.G.nodes[v].get("_dt"))
+                else: self._parked_derives[v].append(u)
+            if u in self.forbidden_depth and attrs["type"] in FORBID_PROPAGATION_TYPES:
+                self._forbid_frontier.add(u)
+
+    def push_primitives(self, items):
+        """接收新的 DSA 原语"""
+        for item in items:
+            self._advance_watermark(parse_dt(item.get("timestamp")))
+            self.dsa_data.append(item)
+            self._pending_items.append(item)
+
+    def flush(self, final=False):
+        """
+        对自上次 flush 以来的增量重跑受影响的阶段，返回新增修正边 (export_raw_logic_graph 的边格式)。
+        迟到的 wasAssociateWith 使 Activity 换了规则时，按旧规则给出的 shouldAdvance 以 type="retracted" 撤回。
+        """
+        horizon_start = self._before_watermark(self.config["stream_horizon_seconds"])
+
+        # Phase 1: UNSUPPORTED 原语要等其引用的节点到达；超出窗口仍未到达的丢弃
+        ready, deferred = [], []
+        for item in self._pending_items:
+            if item.get("type") != "UNSUPPORTED" or item.get("node_id", "") in self.G:
+                ready.append(item)
+            elif not final and parse_dt(item.get("timestamp")) >= horizon_start:
+                deferred.append(item)
+        self._pending_items = deferred
+        for g_id in self._run_phase(self.phase_1_manifestation, ready): self._track_ghost(g_id)
+
+        for act_id in self._new_activities:
+            self._index_trigger_activity(act_id)
+            self._live_activities[act_id] = self._unsettled_commands[act_id] = parse_dt(self.G.nodes[act_id].get("_dt"))
+        self._new_activities = []
+
+        mark = len(self.correction_log)
+        self._run_phase(self.phase_5_validity, list(self._live_activities))
+        seeds = [e["target"] for e in self.correction_log[mark:] if e["type"] == "sforbid"]
+
+        settle_cut = self._bound(datetime.max) if final else self._before_watermark(self.config["stream_settle_seconds"])
+        settled_cmds = [c for c, dt in self._unsettled_commands.items() if dt <= settle_cut]
+        for c in settled_cmds: del self._unsettled_commands[c]
+        for g_id in self._run_phase(self.phase_8_restorative_sgen, settled_cmds, seeds, self._forbid_frontier): self._track_ghost(g_id)
+        self._forbid_frontier = set()
+
+        live_ghosts = list(self._live_ghosts)
+        self._run_phase(self.phase_3_temporal, live_ghosts)
+        self._run_phase(self.phase_2_control_race, live_ghosts)
+
+        advance_cut = self._bound(datetime.max) if final else self._before_watermark(self.config["advance_window_seconds"])
+        settled_ghosts = [g for g, dt in self._unsettled_ghosts.items() if dt <= advance_cut]
+        for g in settled_ghosts: del self._unsettled_ghosts[g]
+        self._run_phase(self.phase_4_inference, settled_ghosts)
+
+        self._run_phase(self.phase_6_lineage, self._dirty_entities, since=horizon_start)
+        self._dirty_entities = set()
+        self._run_phase(self.phase_7_conflict_resolution, list(self._live_derives), list(self._live_ghosts))
+
+        # 滑出窗口的节点不再参与重算
+        for live in (self._live_ghosts, self._live_activities, self._live_derives):
+            for key in [k for k, dt in live.items() if dt < horizon_start]: del live[key]
+
+        new_edges = self.correction_log[self._emitted:]
+        self._emitted = len(self.correction_log)
+        return new_edges
+
+    def close(self):
+        """流结束：不再等待任何窗口，给出全部剩余结论"""
+        return self.flush(final=True)
+
+    def stream(self, batches):
+        """batches 为按时间排序的 {"nodes": [...], "links": [...], "primitives": [...]}，逐条产出修正边"""
+        for batch in batches:
+            self.push_nodes(batch.get("nodes", []), batch.get("links", []))
+            self.push_primitives(batch.get("primitives", []))
+            yield from self.flush()
+        yield from self.close()
+
 # ==========================================
 # 3. 导出与入口
 # ==========================================
@@ -524,4 +1088,7 @@ if __name__ == "__main__":
         engine = LogicEngine(G_cyb, dsa_primitives, abbm_rules)
         corrected_G = engine.run()
         audit_correction_edges(corrected_G)
-        export_raw_logic_graph(corrected_G)
\ No newline at end of file
+        export_raw_logic_graph(corrected_G)
+        save_graph_binary(corrected_G, "shadow_prov_logic_graph.npz")
+        engine.instr.report()
+        engine.instr.export_json("shadow_prov_metrics.json")
\ No newline at end of file
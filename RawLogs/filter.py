@@ -1,9 +1,19 @@
 import json
+import os
+import sys
 
-def filter_and_save_logs(input_file, output_file, allowed_entities):
+current_dir = os.path.dirname(os.path.abspath(__file__))
+# 项目根目录 (RawLogs/ 的上一级)
+project_root = os.path.abspath(os.path.join(current_dir, ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from tool.provlog import load_provenance_events
+
+def filter_and_save_logs(input_file, output_file, allowed_entities, start=None, end=None):
+    # input_file 可以是旧版整文件 JSON，也可以是分段日志的 *_index.json (此时可用 start/end 截取时间范围)
     try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        data = load_provenance_events(input_file, start, end, records=True)
         
         filtered_data = []
         # 用于去重的缓存：记录 (context_id, device, command)
@@ -41,7 +51,7 @@ def filter_and_save_logs(input_file, output_file, allowed_entities):
                     filtered_data.append(event)
 
         with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(filtered_data, f, indent=4, ensure_ascii=False)
+            json.dump([e.to_dict() for e in filtered_data], f, indent=4, ensure_ascii=False)
             
         print(f"成功！过滤后条数: {len(filtered_data)} (原始: {len(data)})")
 
@@ -1,35 +1,198 @@
 # -*- coding: utf-8 -*-
+import gzip
+import io
 import json
 import logging
 import bisect
+from concurrent.futures import ProcessPoolExecutor
 import os
+import sys
 from datetime import datetime, timedelta
 from collections import defaultdict
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 
 import networkx as nx
 from pyvis.network import Network
 
+current_dir = os.path.dirname(os.path.abspath(__file__))
+# 项目根目录 (app/ 的上一级)
+project_root = os.path.abspath(os.path.join(current_dir, ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from tool.timeparse import TimestampParser, parse_offset_iso
+from tool.provlog import load_provenance_events
+
+# 事件时间戳格式 (按原有优先级)；同一份日志通常只命中其中一种，且各格式互斥 (exclusive=True)
+EVENT_TIME_FORMATS = ("%H:%M:%S.%f", "%H:%M:%S", parse_offset_iso, "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%d %H:%M:%S")
+
+# 大图分层渲染 (export_pyvis_lod)：布局在服务端预计算，关闭物理仿真；
+# 每个时间窗口的节点/边以 JSON 块内嵌，只在选中窗口时才解析加载
+LOD_HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>__TITLE__</title>
+<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/vis-network/9.1.2/dist/dist/vis-network.min.css">
+<script src="https://cdnjs.cloudflare.com/ajax/libs/vis-network/9.1.2/dist/vis-network.min.js"></script>
+<style>
+body { margin: 0; display: flex; font-family: sans-serif; background: #f0f0f0; }
+#windows { width: 220px; height: __HEIGHT__; overflow-y: auto; border-right: 1px solid #ccc; }
+#windows div { padding: 4px 8px; cursor: pointer; font-size: 12px; }
+#windows div.active { background: #6495ED; color: #fff; }
+#graph { flex: 1; height: __HEIGHT__; }
+</style>
+</head>
+<body>
+<div id="windows"></div>
+<div id="graph"></div>
+__CHUNKS__
+<script>
+var windows = __WINDOWS__;
+var options = {
+  layout: { hierarchical: { enabled: false } },
+  physics: { enabled: false },
+  edges: { smooth: false, arrows: { to: { enabled: true, scaleFactor: 0.6 } } },
+  nodes: { fixed: true },
+  interaction: { hover: true, navigationButtons: true, hideEdgesOnDrag: true, multiselect: true }
+};
+var network = new vis.Network(document.getElementById("graph"), { nodes: [], edges: [] }, options);
+var list = document.getElementById("windows");
+function load(i) {
+  var data = JSON.parse(document.getElementById("w" + i).textContent);
+  network.setData({ nodes: new vis.DataSet(data.nodes), edges: new vis.DataSet(data.edges) });
+  network.fit();
+  Array.prototype.forEach.call(list.children, function (el, j) { el.className = j === i ? "active" : ""; });
+}
+windows.forEach(function (w, i) {
+  var el = document.createElement("div");
+  el.textContent = w.label + "  (" + w.count + ")";
+  el.onclick = function () { load(i); };
+  list.appendChild(el);
+});
+if (windows.length) load(0);
+</script>
+</body>
+</html>
+"""
+
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class EventIndex:
+    """
+    单遍列式事件索引：原始事件不复制，解析后的时间与字符串 ID 存在平行列中；
+    同时维护按时间排序的行序 (锚点在最前)、实体时间线 (有序时间/ID 数组) 与上下文索引。
+    上下文索引按 (event_type, target_device) 分桶 (非 Command 事件的 target_device 为 None)，桶内按时间有序。
+    append() 支持增量追加，返回新增行 (含新注入的锚点)。
+    """
+    def __init__(self, parse_time):
+        self.parse_time = parse_time
+        self.rows: List[Any] = []          # 原始事件；锚点为新建字典
+        self.dt: List[datetime] = []
+        self.eid: List[str] = []
+        self.order: List[int] = []         # 按时间排序的行号
+        self._order_dt: List[datetime] = []
+        self.n_anchors = 0
+        self.anchor_dt: Optional[datetime] = None
+        self.ev_map: Dict[str, Any] = {}   # event_ID -> 原始事件
+        self.entity_times: Dict[str, List[datetime]] = defaultdict(list)
+        self.entity_eids: Dict[str, List[str]] = defaultdict(list)
+        self.context_index: Dict[str, Dict[tuple, Tuple[List[datetime], List[int]]]] = defaultdict(dict)
+        self._seen_entities = set()
+
+    def __len__(self):
+        return len(self.order)
+
+    def attrs(self, r: int) -> Dict[str, Any]:
+        """节点属性：原始字段 + 规范化的 _dt / event_ID / condition_ids"""
+        d = dict(self.rows[r]); d["_dt"] = self.dt[r]; d["event_ID"] = self.eid[r]
+        if "condition_ids" in d and isinstance(d["condition_ids"], list):
+            d["condition_ids"] = [str(cid) for cid in d["condition_ids"]]
+        return d
+
+    def _add_row(self, e: Any, dt: datetime, eid: str) -> int:
+        self.rows.append(e); self.dt.append(dt); self.eid.append(eid)
+        return len(self.rows) - 1
+
+    def _insert_order(self, r: int):
+        dt = self.dt[r]
+        if not self._order_dt or dt >= self._order_dt[-1]:
+            self.order.append(r); self._order_dt.append(dt)
+        else:
+            i = bisect.bisect_right(self._order_dt, dt, lo=self.n_anchors)
+            self.order.insert(i, r); self._order_dt.insert(i, dt)
+
+    def _insort_entity(self, entity_id: str, dt: datetime, eid: str):
+        times = self.entity_times[entity_id]
+        i = bisect.bisect_right(times, dt)
+        times.insert(i, dt); self.entity_eids[entity_id].insert(i, eid)
+
+    def _index_context(self, ctx_id: str, r: int):
+        e = self.rows[r]; et = e.get("event_type")
+        times, rs = self.context_index[ctx_id].setdefault((et, e.get("target_device") if et == "Command" else None), ([], []))
+        i = bisect.bisect_right(times, self.dt[r])
+        times.insert(i, self.dt[r]); rs.insert(i, r)
+
+    def context_events(self, ctx_id: Any, event_type: str, target_device: Any = None) -> Tuple[List[datetime], List[int]]:
+        """上下文 ctx_id 中 (event_type, target_device) 桶的 (有序时间, 行号)"""
+        return self.context_index.get(str(ctx_id), {}).get((event_type, target_device), ([], []))
+
+    def _add_anchor(self, e: Any, ent_id: str) -> int:
+        anchor_dt = self.anchor_dt
+        v_eid = f"anchor_{ent_id}"
+        anchor_event = {
+            "timestamp": anchor_dt.strftime("%H:%M:%S.%f")[:-3], "device": e.get("condition_entity") or ent_id,
+            "raw_device_id": ent_id, "event_type": "Entity",
+            "description": "Inferred Anchor State", "source": "System_Genesis",
+            "event_ID": v_eid, "session_id": e.get("session_id"),
+            "entity_id": ent_id, "old_state": "unknown",
+            "new_state": e.get("condition_state"), "_dt": anchor_dt
+        }
+        r = self._add_row(anchor_event, anchor_dt, v_eid)
+        self.order.insert(self.n_anchors, r); self._order_dt.insert(self.n_anchors, anchor_dt); self.n_anchors += 1
+        self.ev_map[v_eid] = anchor_event
+        self._seen_entities.add(ent_id)
+        self._insort_entity(ent_id, anchor_dt, v_eid)
+        logger.info(f"Oracle Inference: Injected {ent_id} as '{e.get('condition_state')}'")
+        return r
+
+    def append(self, raw_events) -> List[int]:
+        new = []
+        for e in raw_events:
+            if not e.get("event_ID"): continue
+            dt = self.parse_time(e.get("timestamp") or e.get("time_fired"))
+            if not dt: continue
+            new.append(self._add_row(e, dt, str(e["event_ID"])))
+        new.sort(key=self.dt.__getitem__)
+        if new and self.anchor_dt is None:
+            self.anchor_dt = self.dt[new[0]] - timedelta(seconds=1)
+
+        anchors = []
+        for r in new:
+            self._insert_order(r)
+            e, eid = self.rows[r], self.eid[r]
+            self.ev_map[eid] = e
+            if e.get("event_type") == "Entity":
+                ent_id = e.get("entity_id")
+                self._seen_entities.add(ent_id)
+                if ent_id: self._insort_entity(ent_id, self.dt[r], eid)
+            elif e.get("action") == "condition_check":
+                ent_id = e.get("condition_entity_id")
+                # 条件实体在此之前从未出现过状态：在日志起点前注入一个锚点状态
+                if ent_id and ent_id not in self._seen_entities: anchors.append(self._add_anchor(e, ent_id))
+            ctx_id = e.get("context_id")
+            if ctx_id: self._index_context(str(ctx_id), r)
+        return anchors + new
+
+
 class RobustOriginalPGBuilder:
     def __init__(self, raw_events: List[Dict[str, Any]], height="900px", width="100%"):
-        cleaned = self._validate_and_sanitize(raw_events)
-        self.events = self._inject_anchor_states(cleaned)
-        
-        self.ev_map = {str(e["event_ID"]): e for e in self.events}
-        self.entity_timeline = defaultdict(list)
-        self.context_map = defaultdict(list)
-        
-        for e in self.events:
-            eid = str(e["event_ID"])
-            if e["event_type"] == "Entity" and e.get("entity_id"):
-                self.entity_timeline[e["entity_id"]].append((e["_dt"], eid))
-            ctx_id = e.get("context_id")
-            if ctx_id:
-                self.context_map[str(ctx_id)].append(e)
+        self._time_parser = TimestampParser(EVENT_TIME_FORMATS, exclusive=True)
+        self.index = EventIndex(self._parse_time)
+        self.index.append(raw_events)
+        self.ev_map = self.index.ev_map
 
         self.node_of_event: Dict[str, str] = {}
         self.agent_node_of_event: Dict[str, str] = {}
@@ -40,65 +203,108 @@ class RobustOriginalPGBuilder:
         self.panel_counter = 0
         self.use_concise_labels = True # 默认启用简洁标签
 
-    def _inject_anchor_states(self, cleaned_events: List[Dict]) -> List[Dict]:
-        if not cleaned_events: return cleaned_events
-        state_oracle = {}
-        start_dt = cleaned_events[0]["_dt"]
-        anchor_dt = start_dt - timedelta(seconds=1)
-        anchor_ts = anchor_dt.strftime("%H:%M:%S.%f")[:-3]
-        injected_events = []
+    @property
+    def events(self) -> List[Dict[str, Any]]:
+        """按时间排序的规范化事件 (按需生成)"""
+        return [self.index.attrs(r) for r in self.index.order]
+
+    @classmethod
+    def from_log(cls, path: str, start=None, end=None, **kwargs) -> "RobustOriginalPGBuilder":
+        """从溯源日志构建 (支持分段日志索引，可只读取 [start, end] 时间范围)"""
+        return cls(load_provenance_events(path, start, end, records=True), **kwargs)
+
+    @classmethod
+    def build_multi_session(cls, raw_events: List[Dict[str, Any]], partition="session", window=timedelta(hours=1),
+                            max_workers=None, use_concise_labels=True, **kwargs) -> "RobustOriginalPGBuilder":
+        """
+        多会话并行构建：按 session_id (partition="session") 或不相交时间窗口 (partition="window") 分区，
+        在进程池中分别构建子图，再按分区的起始时间确定性地合并。
+        - session 分区：不同分区的同名节点 (事件 ID 重启、各自的锚点) 加后缀 @session_id 区分
+        - window 分区：每个窗口带入其涉及实体在窗口前的最后状态，跨窗口的 Derive 边由此接上，
+          条件边也能找到之前的状态；带入的节点在合并时与原窗口中的同一节点去重
+        - PanelAgent 节点按合并顺序重新编号
+        """
+        builder = cls(raw_events, **kwargs)
+        idx = builder.index
+        real_rows = idx.order[idx.n_anchors:]
+
+        parts: Dict[Any, List[int]] = {}
+        if partition == "session":
+            for r in real_rows: parts.setdefault(str(idx.rows[r].get("session_id")), []).append(r)
+        elif partition == "window":
+            step = window.total_seconds() or 1
+            t0 = idx.dt[real_rows[0]] if real_rows else None
+            for r in real_rows: parts.setdefault(int((idx.dt[r] - t0).total_seconds() // step), []).append(r)
+        else:
+            raise ValueError(f"未知的分区方式: {partition}")
+        keys = sorted(parts, key=lambda k: (idx.dt[parts[k][0]], str(k)))
+
+        tasks = []
+        # 实体 -> 之前窗口中的最后一个 Entity 行 (初始为全局锚点，避免各窗口各自注入锚点)
+        last_state: Dict[str, int] = {idx.rows[r]["entity_id"]: r for r in idx.order[:idx.n_anchors]}
+        win_of: Dict[int, int] = {}
+        for k in keys:
+            rows = parts[k]
+            if partition == "window":
+                refs = set()
+                for r in rows:
+                    e = idx.rows[r]
+                    refs.update((e.get("entity_id"), e.get("target_device"), e.get("condition_entity_id")))
+                for r in rows: win_of[r] = len(tasks)
+                carry = sorted((last_state[ent] for ent in refs if ent in last_state), key=lambda r: (idx.dt[r], r))
+                for r in rows:
+                    e = idx.rows[r]
+                    if e.get("event_type") == "Entity" and e.get("entity_id"): last_state[e.get("entity_id")] = r
+                rows = carry + rows
+            tasks.append([idx.rows[r] for r in rows])
+
+        if max_workers == 1 or len(tasks) <= 1:
+            results = [_build_partition(t, use_concise_labels) for t in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                results = list(pool.map(_build_partition, tasks, [use_concise_labels] * len(tasks)))
+
+        # 确定性合并：按分区顺序逐个并入
+        G = builder.G; G.clear()
+        builder.use_concise_labels = use_concise_labels
+        for k, (sub, node_of_event, agent_node_of_event, trigger_to_node_map) in zip(keys, results):
+            relabel = {}
+            for n, d in sub.nodes(data=True):
+                if d.get("kind") == "PanelAgent":
+                    builder.panel_counter += 1
+                    relabel[n] = f"PanelAgent_{builder.panel_counter}"
+                    d = {**d, "label": f"User Panel\n#{builder.panel_counter}"}
+                elif n in G and partition == "session":
+                    relabel[n] = f"{n}@{k}"
+                new_id = relabel.get(n, n)
+                if new_id not in G: G.add_node(new_id, **d)
+            for u, v, d in sub.edges(data=True):
+                G.add_edge(relabel.get(u, u), relabel.get(v, v), **d)
+            for src, dst in ((node_of_event, builder.node_of_event), (agent_node_of_event, builder.agent_node_of_event),
+                             (trigger_to_node_map, builder.trigger_to_node_map)):
+                for eid, n in src.items(): dst[eid] = relabel.get(n, n)
+        if partition == "window": builder._stitch_windows(real_rows, win_of)
+        logger.info(f"多会话构建完成: {len(tasks)} 个分区 ({partition}), {G.number_of_nodes()} 节点, {G.number_of_edges()} 边")
+        return builder
 
-        for e in cleaned_events:
+    def _stitch_windows(self, rows, win_of: Dict[int, int]):
+        """窗口分区的拼接：补上跨窗口的 Generate / wasUsedBy 边 (Derive 与条件边已由带入的前置状态处理)"""
+        idx, nodes = self.index, self.node_of_event
+        for r in rows:
+            e, w = idx.rows[r], win_of[r]
             et = e.get("event_type")
-            if et == "Entity":
-                state_oracle[e.get("entity_id")] = f"Entity_{str(e.get('event_ID'))}"
-            elif e.get("action") == "condition_check":
-                ent_id = e.get("condition_entity_id")
-                if ent_id and ent_id not in state_oracle:
-                    v_eid = f"anchor_{ent_id}"
-                    anchor_event = {
-                        "timestamp": anchor_ts, "device": e.get("condition_entity") or ent_id,
-                        "raw_device_id": ent_id, "event_type": "Entity",
-                        "description": "Inferred Anchor State", "source": "System_Genesis",
-                        "event_ID": v_eid, "session_id": e.get("session_id"),
-                        "entity_id": ent_id, "old_state": "unknown",
-                        "new_state": e.get("condition_state"), "_dt": anchor_dt
-                    }
-                    injected_events.append(anchor_event)
-                    state_oracle[ent_id] = f"Entity_{v_eid}"
-                    logger.info(f"Oracle Inference: Injected {ent_id} as '{e.get('condition_state')}'")
-
-        return injected_events + cleaned_events
+            if et == "Entity" and (ctx_id := e.get("context_id")) and (ent_node := nodes.get(idx.eid[r])):
+                times, cmd_rows = idx.context_events(ctx_id, "Command", e.get("entity_id"))
+                for sr in cmd_rows[:bisect.bisect_left(times, idx.dt[r])]:
+                    if win_of[sr] != w and idx.rows[sr].get("status") == "executed" and (cmd_node := nodes.get(idx.eid[sr])):
+                        self.G.add_edge(cmd_node, ent_node, label="Generate", type="Generate")
+            elif et == "Command" and (p_ctx := e.get("parent_context_id")) and (cmd_node := nodes.get(idx.eid[r])):
+                for pr in idx.context_events(p_ctx, "Entity")[1]:
+                    if win_of.get(pr, w) != w and (root := nodes.get(idx.eid[pr])):
+                        self.G.add_edge(root, cmd_node, label="wasUsedBy", type="wasUsedBy")
 
     def _parse_time(self, ts: Any) -> Optional[datetime]:
-        if not ts: return None
-        if isinstance(ts, datetime): return ts
-        for fmt in ("%H:%M:%S.%f", "%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
-            if '%z' in fmt:
-                ts_str = str(ts)
-                if ts_str.endswith('Z'): ts_str = ts_str[:-1] + '+0000'
-                elif '+' in ts_str and ts_str[-3] == ':': ts_str = ts_str[:-3] + ts_str[-2:]
-                try: return datetime.strptime(ts_str, fmt)
-                except ValueError: continue
-            else:
-                try: return datetime.strptime(str(ts), fmt)
-                except ValueError: continue
-        return None
-
-    def _validate_and_sanitize(self, raw: List[Dict]) -> List[Dict]:
-        clean = []
-        for e in raw:
-            if not e.get("event_ID"): continue
-            ts_str = e.get("timestamp") or e.get("time_fired")
-            dt = self._parse_time(ts_str)
-            if not dt: continue
-            
-            new_e = e.copy(); new_e["_dt"] = dt; new_e["event_ID"] = str(e["event_ID"])
-            if "condition_ids" in new_e and isinstance(new_e["condition_ids"], list):
-                new_e["condition_ids"] = [str(cid) for cid in new_e["condition_ids"]]
-            clean.append(new_e)
-        clean.sort(key=lambda x: x["_dt"])
-        return clean
+        return self._time_parser(ts)
 
     def _add_node(self, node_id: str, kind: str, label: str, **attrs):
         shape_map = {
@@ -113,9 +319,11 @@ class RobustOriginalPGBuilder:
             title = "<br>".join([f"<b>{kind}</b>"] + [f"{k}: {v}" for k, v in title_attrs.items()])
             self.G.add_node(node_id, label=label,shape=shape_map.get(kind, "dot"), kind=kind, color=color_map.get(kind, "#eee"), title=title, **attrs)
 
-    def _pass_add_nodes(self):
-        for e in self.events:
-            et, eid = e["event_type"], e["event_ID"]
+    def _pass_add_nodes(self, rows=None):
+        idx = self.index
+        for r in (idx.order if rows is None else rows):
+            e, eid = idx.rows[r], idx.eid[r]
+            et = e["event_type"]
             label = ""
             if self.use_concise_labels:
                 if et == "Entity":
@@ -136,7 +344,7 @@ class RobustOriginalPGBuilder:
                 elif et == "Command": label = f"Activity\n{e.get('command')}\nStatus: {e.get('status')}"
 
             if et == "Entity":
-                self.node_of_event[eid] = f"Entity_{eid}"; self._add_node(self.node_of_event[eid], "Entity", label, **e)
+                self.node_of_event[eid] = f"Entity_{eid}"; self._add_node(self.node_of_event[eid], "Entity", label, **idx.attrs(r))
             elif et == "Agent":
                 node_id = None
                 if e.get("action") == "triggered":
@@ -147,73 +355,168 @@ class RobustOriginalPGBuilder:
                         node_id = self.trigger_to_node_map[rel_id]
                         if "(+Cond)" not in self.G.nodes[node_id].get("label", ""): self.G.nodes[node_id]["label"] += "\n(+Cond)"
                     else: node_id = f"Agent_Orphan_{eid}"
-                if node_id: self.node_of_event[eid] = self.agent_node_of_event[eid] = node_id; self._add_node(node_id, "Agent", label, **e)
+                if node_id: self.node_of_event[eid] = self.agent_node_of_event[eid] = node_id; self._add_node(node_id, "Agent", label, **idx.attrs(r))
             elif et == "Command":
-                self.node_of_event[eid] = f"Command_{eid}"; self._add_node(self.node_of_event[eid], "Activity", label, **e)
+                self.node_of_event[eid] = f"Command_{eid}"; self._add_node(self.node_of_event[eid], "Activity", label, **idx.attrs(r))
 
     def _latest_entity_before(self, entity_id: str, dt: datetime) -> Optional[str]:
-        if not entity_id or entity_id not in self.entity_timeline: return None
-        timeline = self.entity_timeline[entity_id]; idx = bisect.bisect_right(timeline, (dt, "~~~~")); return timeline[idx-1][1] if idx > 0 else None
+        times = self.index.entity_times.get(entity_id) if entity_id else None
+        if not times: return None
+        i = bisect.bisect_right(times, dt); return self.index.entity_eids[entity_id][i-1] if i > 0 else None
 
-    def _pass_add_semantic_edges(self):
-        for e in self.events:
-            eid, et = e["event_ID"], e["event_type"]
+    def _pass_add_semantic_edges(self, new_rows=None):
+        idx = self.index
+        rows, eids, dts = idx.rows, idx.eid, idx.dt
+        for r in (idx.order if new_rows is None else new_rows):
+            e, eid = rows[r], eids[r]
+            et = e["event_type"]
             if et == "Command":
                 cmd_node = self.node_of_event.get(eid)
                 if not cmd_node: continue
                 p_ctx, src = e.get("parent_context_id"), str(e.get("source", ""))
                 if p_ctx:
-                    for ps in self.context_map.get(str(p_ctx), []):
-                        if ps.get("event_type") == "Entity" and (root_eid := str(ps.get("event_ID"))) in self.node_of_event:
+                    for pr in idx.context_events(p_ctx, "Entity")[1]:
+                        if (root_eid := eids[pr]) in self.node_of_event:
                             self.G.add_edge(self.node_of_event[root_eid], cmd_node, label="wasUsedBy", type="wasUsedBy")
                 if src in self.agent_node_of_event: self.G.add_edge(self.agent_node_of_event[src], cmd_node, label="wasAssociateWith", type="wasAssociateWith")
                 elif src == "panel":
                     self.panel_counter += 1; p_node = f"PanelAgent_{self.panel_counter}"
-                    self._add_node(p_node, "PanelAgent", f"User Panel\n#{self.panel_counter}", device="Manual Panel", _dt=e['_dt'])
+                    self._add_node(p_node, "PanelAgent", f"User Panel\n#{self.panel_counter}", device="Manual Panel", _dt=dts[r])
                     self.G.add_edge(p_node, cmd_node, label="wasAssociateWith", type="wasAssociateWith")
                 for cid in e.get("condition_ids", []):
-                    if (cond_ev := self.ev_map.get(str(cid))) and (target_eid := self._latest_entity_before(cond_ev.get("condition_entity_id"), e["_dt"])) in self.node_of_event:
+                    if (cond_ev := self.ev_map.get(str(cid))) and (target_eid := self._latest_entity_before(cond_ev.get("condition_entity_id"), dts[r])) in self.node_of_event:
                         res = cond_ev.get("condition_result"); label = "isConditionOf" if res else "Forbid"
                         self.G.add_edge(self.node_of_event[target_eid], cmd_node, label=f"{label}\n({cond_ev.get('condition_state')})", type=label, color="green" if res else "red")
             elif et == "Entity":
                 if (curr_entity_node := self.node_of_event.get(eid)) and (ctx_id := e.get("context_id")):
-                    for sibling in self.context_map.get(str(ctx_id), []):
-                        if sibling.get("event_type") == "Command" and e["_dt"] > sibling["_dt"] and sibling.get("target_device") == e.get("entity_id") and sibling.get("status") == "executed" and (cmd_eid := str(sibling["event_ID"])) in self.node_of_event:
+                    # 同上下文中、作用于本实体且时间更早的 Command
+                    times, cmd_rows = idx.context_events(ctx_id, "Command", e.get("entity_id"))
+                    for sr in cmd_rows[:bisect.bisect_left(times, dts[r])]:
+                        if rows[sr].get("status") == "executed" and (cmd_eid := eids[sr]) in self.node_of_event:
                             self.G.add_edge(self.node_of_event[cmd_eid], curr_entity_node, label="Generate", type="Generate")
 
     def _pass_add_derive(self):
-        for _, timeline in self.entity_timeline.items():
-            for i in range(1, len(timeline)):
-                if (prev := self.node_of_event.get(timeline[i-1][1])) and (curr := self.node_of_event.get(timeline[i][1])):
+        for eids in self.index.entity_eids.values():
+            for i in range(1, len(eids)):
+                if (prev := self.node_of_event.get(eids[i-1])) and (curr := self.node_of_event.get(eids[i])):
+                    self.G.add_edge(prev, curr, label="Derive", type="Derive")
+
+    def _patch_generate(self, new_rows):
+        """新 Command 的执行结果可能早已到达：补上指向已有同上下文 Entity 的 Generate 边"""
+        idx = self.index
+        rows, eids, dts = idx.rows, idx.eid, idx.dt
+        new = set(new_rows)
+        for r in new_rows:
+            e = rows[r]
+            if e.get("event_type") != "Command" or e.get("status") != "executed" or not (ctx_id := e.get("context_id")): continue
+            if not (cmd_node := self.node_of_event.get(eids[r])): continue
+            times, ent_rows = idx.context_events(ctx_id, "Entity")
+            for sr in ent_rows[bisect.bisect_right(times, dts[r]):]:
+                if sr not in new and rows[sr].get("entity_id") == e.get("target_device") and (ent_node := self.node_of_event.get(eids[sr])):
+                    self.G.add_edge(cmd_node, ent_node, label="Generate", type="Generate")
+
+    def _patch_derive(self, new_rows):
+        """只修补受影响实体的 Derive 链：从第一个新事件的前驱开始重连，插入链中间时断开旧边"""
+        idx = self.index
+        first_dt: Dict[str, datetime] = {}
+        for r in new_rows:
+            e = idx.rows[r]
+            if e.get("event_type") == "Entity" and (ent_id := e.get("entity_id")):
+                if ent_id not in first_dt or idx.dt[r] < first_dt[ent_id]: first_dt[ent_id] = idx.dt[r]
+        new = {idx.eid[r] for r in new_rows}
+        nodes = self.node_of_event
+        for ent_id, dt in first_dt.items():
+            eids = idx.entity_eids[ent_id]
+            i0 = bisect.bisect_left(idx.entity_times[ent_id], dt)
+            while eids[i0] not in new: i0 += 1
+            old_chain = [x for x in eids[max(i0-1, 0):] if x not in new]
+            for a, b in zip(old_chain, old_chain[1:]):
+                u, v = nodes.get(a), nodes.get(b)
+                if self.G.has_edge(u, v) and self.G.edges[u, v].get("type") == "Derive": self.G.remove_edge(u, v)
+            for i in range(max(i0, 1), len(eids)):
+                if (prev := nodes.get(eids[i-1])) and (curr := nodes.get(eids[i])):
                     self.G.add_edge(prev, curr, label="Derive", type="Derive")
 
     def build(self, use_concise_labels=True):
         self.use_concise_labels = use_concise_labels
         self.G.clear() # Ensure graph is empty before building
+        self.node_of_event.clear(); self.agent_node_of_event.clear(); self.trigger_to_node_map.clear(); self.panel_counter = 0
         self._pass_add_nodes(); self._pass_add_semantic_edges(); self._pass_add_derive(); return self.G
 
+    def extend(self, new_events: List[Dict[str, Any]]):
+        """
+        增量构建：只为新事件添加节点与 Generate / wasUsedBy / isConditionOf / Forbid / Derive 边，
+        并修补受影响实体的 Derive 链尾。适合长会话中的周期性刷新。
+        注意：迟到事件不会回溯修改已有 Command 的条件边 (需要时调用 build() 全量重建)。
+        """
+        new_rows = self.index.append(new_events)
+        if not new_rows: return self.G
+        self._pass_add_nodes(new_rows); self._pass_add_semantic_edges(new_rows)
+        self._patch_generate(new_rows); self._patch_derive(new_rows)
+        return self.G
 
-    def export_json(self, path="provenance_data.json"):
-        """将图结构导出为便于程序分析的 JSON 格式"""
+
+    @staticmethod
+    def _open_export(path: str, compress: Optional[str] = None):
+        """按 compress (或 .gz / .zst 后缀) 打开文本输出流；zstd 需要可选依赖 zstandard"""
+        if compress is None:
+            compress = "gzip" if path.endswith(".gz") else "zstd" if path.endswith(".zst") else None
+        if compress == "gzip":
+            return gzip.open(path, 'wt', encoding='utf-8')
+        if compress == "zstd":
+            try:
+                import zstandard
+            except ImportError as e:
+                raise ImportError("zstd 压缩需要安装 zstandard (pip install zstandard)") from e
+            return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, 'wb')), encoding='utf-8')
+        return open(path, 'w', encoding='utf-8')
+
+    def _write_node_link(self, f, indent: Optional[int] = 2):
+        """流式写出 node_link_data 结构：逐个节点/边序列化，datetime 在同一遍中转为 ISO 字符串"""
+        skeleton = nx.node_link_data(nx.DiGraph())  # 与当前 networkx 版本的键名/顺序一致 (links / edges)
+        link_key = [k for k in skeleton if k not in ("directed", "multigraph", "graph", "nodes")][0]
+        nodes = ({**{k: v.isoformat() if isinstance(v, datetime) else v for k, v in d.items()}, "id": n} for n, d in self.G.nodes(data=True))
+        links = ({**d, "source": u, "target": v} for u, v, d in self.G.edges(data=True))
+        sections = {"directed": self.G.is_directed(), "multigraph": self.G.is_multigraph(), "graph": self.G.graph, "nodes": nodes, link_key: links}
+
+        if indent is None:
+            dumps = lambda o: json.dumps(o, ensure_ascii=False, separators=(",", ":"))
+            f.write("{")
+            for i, (k, v) in enumerate(sections.items()):
+                f.write(("," if i else "") + json.dumps(k) + ":")
+                if k not in ("nodes", link_key): f.write(dumps(v)); continue
+                f.write("[")
+                for j, item in enumerate(v): f.write(("," if j else "") + dumps(item))
+                f.write("]")
+            f.write("}")
+            return
+
+        # 与 json.dump(data, indent=indent) 的输出逐字节一致
+        pad = " " * indent
+        dumps = lambda o, depth: json.dumps(o, indent=indent, ensure_ascii=False).replace("\n", "\n" + pad * depth)
+        f.write("{\n")
+        for i, (k, v) in enumerate(sections.items()):
+            f.write((",\n" if i else "") + pad + json.dumps(k) + ": ")
+            if k not in ("nodes", link_key): f.write(dumps(v, 1)); continue
+            empty = True
+            for item in v:
+                f.write(("[\n" if empty else ",\n") + pad * 2 + dumps(item, 2)); empty = False
+            f.write("[]" if empty else "\n" + pad + "]")
+        f.write("\n}")
+
+    def export_json(self, path="provenance_data.json", indent: Optional[int] = 2, compress: Optional[str] = None):
+        """
+        将图结构导出为便于程序分析的 JSON 格式 (networkx node_link_data 结构)。
+        流式写出，不在内存中构建整图的字典副本；indent=None 为紧凑模式，
+        compress="gzip" / "zstd" (或 .gz / .zst 后缀) 时压缩输出。
+        """
         try:
-            # 使用 networkx 的 node_link_data 格式
-            # 它会生成一个包含 "nodes" 和 "links" 的字典
-            data = nx.node_link_data(self.G)
-            
-            # 清理数据以确保 JSON 可序列化（移除 datetime 对象）
-            for node in data['nodes']:
-                for k, v in list(node.items()):
-                    if isinstance(v, datetime):
-                        node[k] = v.isoformat()
-            
-            with open(path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-            
+            with self._open_export(path, compress) as f:
+                self._write_node_link(f, indent)
             logger.info(f"溯源数据 JSON 已导出至: {path}")
         except Exception as e:
             logger.error(f"导出 JSON 失败: {e}")
 
-
     def export_pyvis(self, path="provenance_graph.html", mode="B", layout_direction="UD"):
         sub_G = self.G.copy()
         # 模式过滤逻辑
@@ -294,6 +597,131 @@ class RobustOriginalPGBuilder:
         logger.info(f"PyVis Graph (Mode: {mode}) exported to: {path}")
 
 
+    def _mode_view(self, mode="B"):
+        """按导出模式过滤的只读子图视图 (不复制图)"""
+        G = self.G
+        if mode == "A":
+            return nx.subgraph_view(G, filter_node=lambda n: str(G.nodes[n].get('status')).lower() != 'blocked',
+                                    filter_edge=lambda u, v: G.edges[u, v].get('type') != 'Forbid')
+        if mode == "C":
+            relevant_nodes = set()
+            for u, v, d in G.edges(data=True):
+                if d.get('type') == 'Forbid' or str(G.nodes[v].get('status', '')).lower() == 'blocked':
+                    relevant_nodes.update([u, v])
+            return G.subgraph(relevant_nodes)
+        return G
+
+    def _collapse_derive_runs(self, H, min_run=3):
+        """
+        把 Derive 链上连续的"纯"状态更新 (只有链内 Derive 边，如传感器重复上报) 折叠为摘要节点。
+        返回 (节点 -> 摘要节点, 摘要节点 -> 成员列表)。
+        """
+        rep, summaries = {}, {}
+        def plain(n):
+            if n is None or n not in H or H.in_degree(n) > 1 or H.out_degree(n) > 1: return False
+            return all(H.edges[p, n].get("type") == "Derive" for p in H.predecessors(n)) and \
+                   all(H.edges[n, c].get("type") == "Derive" for c in H.successors(n))
+        for eids in self.index.entity_eids.values():
+            run = []
+            for eid in eids + [None]:
+                n = self.node_of_event.get(eid) if eid is not None else None
+                if plain(n): run.append(n); continue
+                if len(run) >= min_run:
+                    sid = f"Summary_{run[0]}"; summaries[sid] = run
+                    for m in run: rep[m] = sid
+                run = []
+        return rep, summaries
+
+    def export_pyvis_lod(self, path="provenance_graph_lod.html", mode="B", layout_direction="UD",
+                         window=timedelta(minutes=10), min_run=3, level_sep=120, lane_sep=260):
+        """
+        大图的可扩展导出 (export_pyvis 在几千节点以上基本不可用)：
+        - 不复制图：按模式过滤使用子图视图
+        - 折叠 Derive 链上的连续重复状态更新为摘要节点
+        - 服务端预计算分层布局：纵向按时间排名，横向按设备泳道，浏览器端关闭物理仿真
+        - 按时间窗口分块内嵌，页面只在选中窗口时解析该窗口 (跨窗口边的端点以浅色显示)
+        """
+        H = self._mode_view(mode)
+        rep, summaries = self._collapse_derive_runs(H, min_run)
+
+        # 1. 显示节点 (摘要节点取首个成员的时间)
+        items: Dict[str, Dict[str, Any]] = {}
+        for n, d in H.nodes(data=True):
+            if n in rep: continue
+            kind = d.get("kind")
+            if kind == "Entity": lane = d.get("entity_id")
+            elif kind == "Activity": lane = d.get("target_device")
+            elif kind == "Agent": lane = f"agent:{d.get('device')}"
+            else: lane = "panel"
+            items[n] = {"id": n, "label": d.get("label", n), "title": d.get("title", ""), "shape": d.get("shape", "dot"),
+                        "color": d.get("color", "#eee"), "_dt": d.get("_dt"), "_lane": str(lane)}
+        for sid, members in summaries.items():
+            first, last = self.G.nodes[members[0]], self.G.nodes[members[-1]]
+            ent_id = first.get("entity_id", "")
+            short_id = ent_id.split('.')[-1] if '.' in ent_id else ent_id
+            span = f"{first.get('timestamp', '')} ~ {last.get('timestamp', '')}"
+            items[sid] = {"id": sid, "label": f"Entity\n{short_id}\n×{len(members)} updates\n{first.get('old_state','?')} → {last.get('new_state','?')}",
+                          "title": f"<b>Collapsed Derive chain</b><br>entity_id: {ent_id}<br>updates: {len(members)}<br>{span}",
+                          "shape": "ellipse", "color": "#B0C4DE", "_dt": first.get("_dt"), "_lane": str(ent_id)}
+
+        edges = {}
+        for u, v, d in H.edges(data=True):
+            a, b = rep.get(u, u), rep.get(v, v)
+            if a == b or (a, b) in edges: continue
+            e = {"from": a, "to": b, "label": d.get("label", ""), "title": d.get("type", "")}
+            if d.get("color"): e["color"] = d["color"]
+            edges[(a, b)] = e
+
+        # 2. 服务端分层布局：时间的稠密排名为层，泳道按首次出现排序
+        by_time = sorted(items.values(), key=lambda it: (it["_dt"] or datetime.min, it["id"]))
+        lanes: Dict[str, int] = {}
+        level, prev_dt = -1, object()
+        for it in by_time:
+            if it["_dt"] != prev_dt: level += 1; prev_dt = it["_dt"]
+            lane = lanes.setdefault(it["_lane"], len(lanes))
+            x, y = lane * lane_sep, level * level_sep
+            it["x"], it["y"] = (x, y) if layout_direction in ("UD", "DU") else (y, x)
+            if layout_direction in ("DU", "RL"): it["x"], it["y"] = -it["x"], -it["y"]
+
+        # 3. 按时间窗口分块
+        t0 = next((it["_dt"] for it in by_time if it["_dt"]), None)
+        step = window.total_seconds() or 1
+        win_of = {it["id"]: int(((it["_dt"] - t0).total_seconds() if it["_dt"] and t0 else 0) // step) for it in by_time}
+        chunks: Dict[int, Dict[str, List]] = defaultdict(lambda: {"nodes": [], "edges": [], "ghosts": set()})
+        for it in by_time:
+            chunks[win_of[it["id"]]]["nodes"].append({k: v for k, v in it.items() if not k.startswith("_")})
+        for (a, b), e in edges.items():
+            wa, wb = win_of[a], win_of[b]
+            chunks[wa]["edges"].append(e)
+            if wb != wa:
+                chunks[wb]["edges"].append(e); chunks[wa]["ghosts"].add(b); chunks[wb]["ghosts"].add(a)
+
+        windows, blocks = [], []
+        for i, w in enumerate(sorted(chunks)):
+            c = chunks[w]
+            for g in sorted(c["ghosts"]):
+                ghost = {k: v for k, v in items[g].items() if not k.startswith("_")}
+                ghost.update(color="#dddddd", font={"color": "#999999"})
+                c["nodes"].append(ghost)
+            start = t0 + timedelta(seconds=w * step) if t0 else None
+            windows.append({"label": start.strftime("%H:%M:%S") if start else "-", "count": len(c["nodes"]) - len(c["ghosts"])})
+            payload = json.dumps({"nodes": c["nodes"], "edges": c["edges"]}, ensure_ascii=False, separators=(",", ":")).replace("</", "<\\/")
+            blocks.append(f'<script type="application/json" id="w{i}">{payload}</script>')
+
+        html = (LOD_HTML_TEMPLATE.replace("__TITLE__", f"Provenance Graph (Mode: {mode})").replace("__HEIGHT__", self.height)
+                .replace("__WINDOWS__", json.dumps(windows, ensure_ascii=False)).replace("__CHUNKS__", "\n".join(blocks)))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(html)
+        logger.info(f"LOD Graph (Mode: {mode}, {len(items)} nodes, {len(summaries)} collapsed runs, {len(windows)} windows) exported to: {path}")
+
+
+def _build_partition(events: List[Any], use_concise_labels: bool = True):
+    """进程池任务：构建一个分区的子图，返回图与事件 -> 节点映射"""
+    b = RobustOriginalPGBuilder(events)
+    b.build(use_concise_labels=use_concise_labels)
+    return b.G, b.node_of_event, b.agent_node_of_event, b.trigger_to_node_map
+
+
 if __name__ == "__main__":
     try:
         json_path = '../RawLogs/A1/S2/delay/filtered_logs.json' 
@@ -321,6 +749,10 @@ if __name__ == "__main__":
             logger.info("正在导出 Mode 'C' (仅失败路径)...")
             builder.export_pyvis("graph_C_violations_concise.html", mode="C", layout_direction="UD")
 
+            # 大图：预计算布局 + 折叠重复更新 + 按时间窗口懒加载
+            logger.info("正在导出 Mode 'B' (分层懒加载)...")
+            builder.export_pyvis_lod("graph_B_lod.html", mode="B", layout_direction="UD")
+
             logger.info("\n所有图形已成功导出！")
             
     except Exception as e: 
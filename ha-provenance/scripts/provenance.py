@@ -1,10 +1,15 @@
 from __future__ import annotations
 from contextvars import ContextVar
 from typing import Any, Dict, List, Optional, Tuple, Sequence, TYPE_CHECKING
+import asyncio
 import logging
 import json
 import os
-from datetime import datetime
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 import uuid
 
 if TYPE_CHECKING:
@@ -19,86 +24,495 @@ def set_global_hass(hass: Any):
     """注入HASS实例，用于查表"""
     global _HASS_REF
     _HASS_REF = hass
+    invalidate_entity_cache()
+    _subscribe_registry_updates(hass)
+    _protect_from_hass(hass)
+    _subscribe_automation_reloads(hass)
     
 # 定义事件类型
 EVENT_TYPE_ENTITY = "Entity"
 EVENT_TYPE_COMMAND = "Command"
 EVENT_TYPE_AGENT = "Agent"
 
+
+# ========== 事件记录 ==========
+_EVENT_BASE_FIELDS = (
+    "timestamp", "device", "raw_device_id", "event_type", "description", "source", "event_ID",
+    "session_id", "action", "context_id", "parent_context_id",
+)
+# 可选字段只收 record_event 总是先于条件信息/额外属性写入的字段，保证 to_dict() 的字段顺序不变
+_EVENT_OPTIONAL_FIELDS = (
+    "area", "entity_id", "old_state", "new_state", "target_activity", "forbidden_activity",
+    "condition_ids", "command", "target_device",
+)
+_EVENT_SLOTS = frozenset(_EVENT_BASE_FIELDS + _EVENT_OPTIONAL_FIELDS)
+# 取值集合很小、在事件间大量重复的字段，统一驻留为同一个字符串对象
+_EVENT_INTERNED = frozenset((
+    "device", "raw_device_id", "event_type", "session_id", "action", "area",
+    "entity_id", "command", "target_device", "automation_id", "status",
+))
+_INTERN_CAPACITY = 100000
+_intern_table: Dict[str, str] = {}
+_MISSING = object()
+
+
+def _intern(value: str) -> str:
+    if len(_intern_table) >= _INTERN_CAPACITY:
+        _intern_table.clear()
+    return _intern_table.setdefault(value, value)
+
+
+class ProvEvent:
+    """
+    紧凑的事件记录：常用字段存在 __slots__ 中，其余字段 (条件信息、额外属性) 放进 extra。
+    提供 dict 风格的读写接口 (get / [] / in / items / copy)，导出时再用 to_dict() 生成字典，
+    字段顺序与原来的事件字典一致。
+    """
+    __slots__ = _EVENT_BASE_FIELDS + _EVENT_OPTIONAL_FIELDS + ("extra",)
+
+    def __init__(self, fields: Optional[Dict[str, Any]] = None):
+        for name in _EVENT_SLOTS:
+            setattr(self, name, _MISSING)
+        self.extra: Optional[Dict[str, Any]] = None
+        if fields:
+            self.update(fields)
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "ProvEvent":
+        return cls(d)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in _EVENT_INTERNED and type(value) is str:
+            value = _intern(value)
+        if key in _EVENT_SLOTS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _EVENT_SLOTS:
+            value = getattr(self, key)
+        else:
+            value = self.extra.get(key, _MISSING) if self.extra else _MISSING
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def update(self, fields: Dict[str, Any]) -> None:
+        for k, v in fields.items():
+            self[k] = v
+
+    def keys(self) -> List[str]:
+        names = [n for n in _EVENT_BASE_FIELDS + _EVENT_OPTIONAL_FIELDS if getattr(self, n) is not _MISSING]
+        return names + list(self.extra) if self.extra else names
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return [(k, self[k]) for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def copy(self) -> Dict[str, Any]:
+        return self.to_dict()
+
+    def __reduce__(self):
+        # _MISSING 哨兵不能跨进程 pickle，按字段重建 (供多进程构建使用)
+        return (ProvEvent, (self.to_dict(),))
+
+    def __repr__(self) -> str:
+        return f"ProvEvent({self.to_dict()!r})"
+
+
+def event_as_dict(event: Any) -> Dict[str, Any]:
+    return event.to_dict() if isinstance(event, ProvEvent) else event
+
+# 事件存储容量 (内存中最多保留的事件数 / 每个封存段的事件数)
+EVENT_STORE_CAPACITY = 50000
+EVENT_SEGMENT_SIZE = 1000
+CONTEXT_MAP_CAPACITY = 20000
+# 封存段的落盘目录 (与 save_log 的目录一致，共用同一份分段日志)，可通过环境变量覆盖
+DEFAULT_SPILL_DIR = os.environ.get(
+    "HA_PROVENANCE_SPILL_DIR", "/home/homeassistant/.homeassistant/provenance_logs/")
+# 分段日志的轮转阈值
+LOG_SEGMENT_MAX_BYTES = 8 * 1024 * 1024
+LOG_SEGMENT_MAX_SECONDS = 3600
+
+
+class EventStore:
+    """
+    环形事件缓冲：内存中只保留最近 capacity 条事件。
+    每满 segment_size 条封存为一个段，交给后台线程调用 sink(segment) 落盘，
+    HA 回调里只做 O(1) 的追加，不做任何磁盘 IO。
+    对外保留 list 的读接口 (len / 迭代 / 下标)，兼容原来的 event_log 用法。
+    """
+    def __init__(self, capacity: int = EVENT_STORE_CAPACITY, segment_size: int = EVENT_SEGMENT_SIZE, sink=None):
+        self.capacity = capacity
+        self.segment_size = segment_size
+        self.sink = sink
+        self.evicted = 0
+        self.sealed = 0
+        self._ring: deque = deque(maxlen=capacity)
+        self._active: List[ProvEvent] = []
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+
+    def append(self, event: ProvEvent) -> None:
+        with self._lock:
+            if len(self._ring) == self.capacity:
+                self.evicted += 1
+            self._ring.append(event)
+            self._active.append(event)
+            if len(self._active) >= self.segment_size:
+                self._seal_locked()
+
+    def _seal_locked(self) -> None:
+        segment, self._active = self._active, []
+        self.sealed += 1
+        if self.sink is None:
+            return
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="provenance-flush", daemon=True)
+            self._worker.start()
+        self._queue.put_nowait(segment)
+
+    def _run(self) -> None:
+        while True:
+            segment = self._queue.get()
+            try:
+                if segment is None:
+                    return
+                self.sink(segment)
+            except Exception as e:
+                _LOGGER.error(f"Failed to flush provenance segment: {e}")
+            finally:
+                self._queue.task_done()
+
+    def seal(self) -> None:
+        """把当前未满的段提前封存 (异步落盘)"""
+        with self._lock:
+            if self._active:
+                self._seal_locked()
+
+    def flush(self) -> None:
+        """封存当前段并等待后台线程写完 (仅在关机/保存时调用)"""
+        self.seal()
+        if self._worker is not None and self._worker.is_alive():
+            self._queue.join()
+
+    def close(self) -> None:
+        self.flush()
+        if self._worker is not None and self._worker.is_alive():
+            self._queue.put_nowait(None)
+            self._worker.join()
+        self._worker = None
+
+    def resize(self, capacity: int) -> None:
+        with self._lock:
+            self.capacity = capacity
+            self._ring = deque(self._ring, maxlen=capacity)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._ring.clear()
+            self._active = []
+
+    def snapshot(self) -> List[ProvEvent]:
+        with self._lock:
+            return list(self._ring)
+
+    def since(self, event_id: int) -> List[ProvEvent]:
+        """内存窗口中 event_ID 大于 event_id 的事件 (从尾部向前扫，代价与新事件数成正比)"""
+        out = []
+        with self._lock:
+            for e in reversed(self._ring):
+                if e["event_ID"] <= event_id:
+                    break
+                out.append(e)
+        return out[::-1]
+
+    def __len__(self) -> int:
+        return len(self._ring)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.snapshot()[idx]
+        return self._ring[idx]
+
+
+def _event_datetime(ts: str, ref: datetime) -> datetime:
+    """事件时间戳只有时分秒，按写入时刻 ref 补全日期 (晚于 ref 的视为前一天)"""
+    try:
+        t = datetime.strptime(ts, "%H:%M:%S.%f").time()
+    except (TypeError, ValueError):
+        return ref
+    dt = datetime.combine(ref.date(), t)
+    return dt - timedelta(days=1) if dt > ref + timedelta(minutes=1) else dt
+
+
+class SegmentedLogWriter:
+    """
+    追加写的分段 JSONL 日志：每行一个事件，按大小或时间轮转为 <name>_<序号>.jsonl。
+    索引文件 <name>_index.json 记录每段的文件名、event_ID 范围与起止时间，
+    下游 (tool/provlog.py) 据此按时间范围定位段，无需加载全部历史。
+    同一会话内 event_ID 单调递增，已写过的事件会被跳过，重复保存是幂等的。
+    """
+    def __init__(self, base_dir: str, name: str, max_bytes: int = LOG_SEGMENT_MAX_BYTES, max_seconds: float = LOG_SEGMENT_MAX_SECONDS):
+        self.base_dir = base_dir
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.index_path = os.path.join(base_dir, f"{name}_index.json")
+        self.segments: List[Dict[str, Any]] = []
+        self.last_event_id = 0
+        self._lock = threading.Lock()
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.segments = json.load(f).get("segments", [])
+            if self.segments:
+                self.last_event_id = self.segments[-1]["last_id"]
+
+    def _rotate_due(self, seg: Dict[str, Any], start: datetime) -> bool:
+        if seg["bytes"] >= self.max_bytes:
+            return True
+        return (start - datetime.fromisoformat(seg["start"])).total_seconds() >= self.max_seconds
+
+    def append(self, events: List[ProvEvent]) -> int:
+        """追加一批事件，返回实际写入的条数"""
+        with self._lock:
+            fresh = [e for e in events if e["event_ID"] > self.last_event_id]
+            if not fresh:
+                return 0
+            now = datetime.now()
+            start = _event_datetime(fresh[0].get("timestamp"), now)
+            end = _event_datetime(fresh[-1].get("timestamp"), now)
+
+            seg = self.segments[-1] if self.segments else None
+            if seg is None or self._rotate_due(seg, start):
+                seg = {"file": f"{self.name}_{len(self.segments):05d}.jsonl", "first_id": fresh[0]["event_ID"],
+                       "last_id": None, "start": start.isoformat(), "end": None, "count": 0, "bytes": 0}
+                self.segments.append(seg)
+
+            data = "".join(json.dumps(event_as_dict(e), ensure_ascii=False, default=str) + "\n" for e in fresh)
+            os.makedirs(self.base_dir, exist_ok=True)
+            with open(os.path.join(self.base_dir, seg["file"]), 'a', encoding='utf-8') as f:
+                f.write(data)
+            seg["last_id"] = fresh[-1]["event_ID"]
+            seg["end"] = end.isoformat()
+            seg["count"] += len(fresh)
+            seg["bytes"] += len(data.encode('utf-8'))
+            self.last_event_id = seg["last_id"]
+            self._write_index()
+            return len(fresh)
+
+    def _write_index(self) -> None:
+        tmp = self.index_path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"name": self.name, "segments": self.segments}, f, ensure_ascii=False)
+        os.replace(tmp, self.index_path)
+
+
+# 每个 (目录, 前缀) 在一次会话里只有一个 writer；会话名带启动时间戳
+_log_writers: Dict[Tuple[str, str], SegmentedLogWriter] = {}
+_session_stamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+
+
+def _new_session_stamp(previous: str) -> str:
+    """新会话的文件名时间戳；与上一会话同一秒时加序号，避免续写上一会话的索引"""
+    stamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    if not previous.startswith(stamp):
+        return stamp
+    n = int(previous[len(stamp) + 1:]) + 1 if len(previous) > len(stamp) else 1
+    return f"{stamp}-{n}"
+
+
+def get_log_writer(base_dir: str, prefix: str = "provenance_log") -> SegmentedLogWriter:
+    key = (os.path.abspath(base_dir), prefix)
+    writer = _log_writers.get(key)
+    if writer is None:
+        writer = _log_writers[key] = SegmentedLogWriter(base_dir, f"{prefix}_{_session_stamp}")
+    return writer
+
+
+class BoundedMap(OrderedDict):
+    """按插入顺序淘汰最旧条目的定长映射 (context.id -> event_ID)"""
+    def __init__(self, capacity: int = CONTEXT_MAP_CAPACITY):
+        super().__init__()
+        self.capacity = capacity
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.move_to_end(key)
+        super().__setitem__(key, value)
+        if len(self) > self.capacity:
+            self.popitem(last=False)
+
+
 # 全局事件存储
-event_log: List[Dict[str, Any]] = []
+event_log = EventStore()
+_spill_dir = ""  # 当前封存段的落盘目录 ("" 表示不落盘)
 event_id_counter = 1
-context_id_map: Dict[str, int] = {}  # context.id -> event_ID
+context_id_map = BoundedMap()  # context.id -> event_ID
+
+
+def configure_event_store(capacity: Optional[int] = None, segment_size: Optional[int] = None, spill_dir: Optional[str] = None) -> None:
+    """调整事件存储容量与落盘目录 (spill_dir="" 关闭落盘，封存段只在内存中轮转)"""
+    if capacity is not None:
+        event_log.resize(capacity)
+    if segment_size is not None:
+        event_log.segment_size = segment_size
+    global _spill_dir
+    if spill_dir is not None:
+        _spill_dir = spill_dir
+        event_log.sink = get_log_writer(spill_dir).append if spill_dir else None
 context_vars: ContextVar[Dict[str, Any]] = ContextVar(
     "context_vars", default={}
 )
 
 
+# 自动化运行记录的保留策略：结束的运行保留 RUN_TTL_SECONDS 秒，
+# 未正常结束的运行最多保留 RUN_ACTIVE_TTL_SECONDS 秒，总数不超过 MAX_TRACKED_RUNS
+RUN_TTL_SECONDS = 300
+RUN_ACTIVE_TTL_SECONDS = 3600
+MAX_TRACKED_RUNS = 5000
+
+
 # 状态机：跟踪自动化执行状态和条件关联
 class StateMachine:
-    def __init__(self):
-        # automation_id -> state (存储完整条件链和目标活动)
-        self.automation_states: Dict[str, Dict[str, Any]] = {}
+    """
+    按“运行”跟踪自动化：一次触发 = 一个运行，键为 (automation_id, 触发 context.id)。
+    条件检查与命令在自动化自己的 context 下执行，其 parent_id 即触发 context，
+    因此查找时依次尝试 context.id / context.parent_id，找不到再退回该自动化最近一次运行。
+    """
+    def __init__(self, run_ttl: float = RUN_TTL_SECONDS, active_ttl: float = RUN_ACTIVE_TTL_SECONDS, max_runs: int = MAX_TRACKED_RUNS):
+        self.run_ttl = run_ttl
+        self.active_ttl = active_ttl
+        self.max_runs = max_runs
+        # (automation_id, run_id) -> state (存储完整条件链和目标活动)，按开始时间排序
+        self.runs: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self.latest_run: Dict[str, Tuple[str, str]] = {}  # automation_id -> 最近一次运行
         self.automation_commands: Dict[str,
                                        List[Dict[str, Any]]] = {}  # 自动化命令跟踪
-        self.automation_conditions: Dict[str, List[int]] = {}  # 存储所有条件事件ID
 
-    def start_automation(self, automation_id: str, trigger_event_id: int) -> None:
+    @property
+    def automation_states(self) -> Dict[str, Dict[str, Any]]:
+        """每个自动化最近一次运行的状态 (只读视图)"""
+        return {aid: self.runs[key] for aid, key in self.latest_run.items() if key in self.runs}
+
+    def _resolve(self, automation_id: str, context: Any = None) -> Optional[Dict[str, Any]]:
+        if context is not None:
+            for run_id in (getattr(context, "id", None), getattr(context, "parent_id", None)):
+                if run_id and (automation_id, run_id) in self.runs:
+                    return self.runs[(automation_id, run_id)]
+        key = self.latest_run.get(automation_id)
+        return self.runs.get(key) if key else None
+
+    def _evict(self, now: float) -> None:
+        """从最早的运行开始淘汰过期记录 (运行按开始时间有序，遇到未过期的即停止)"""
+        while self.runs:
+            key, state = next(iter(self.runs.items()))
+            ended = state["ended_at"]
+            expired = (now - state["started_at"] > self.active_ttl) or (ended is not None and now - ended > self.run_ttl)
+            if not expired and len(self.runs) <= self.max_runs:
+                break
+            self.runs.popitem(last=False)
+            if self.latest_run.get(key[0]) == key:
+                del self.latest_run[key[0]]
+
+    def start_automation(self, automation_id: str, trigger_event_id: int, context: Any = None) -> None:
         """记录自动化开始执行，初始化条件链"""
-        self.automation_states[automation_id] = {
+        now = time.monotonic()
+        self._evict(now)
+        run_id = getattr(context, "id", None) or f"event:{trigger_event_id}"
+        key = (automation_id, run_id)
+        self.runs.pop(key, None)
+        self.runs[key] = {
             "active": True,
             "trigger_event_id": trigger_event_id,
             "last_condition_id": None,
             "condition_passed": True,
             "current_step": "trigger",
-            "target_activity": None  # 最终触发的Command ID
+            "target_activity": None,  # 最终触发的Command ID
+            "conditions": [],  # 本次运行的所有条件事件ID
+            "run_id": run_id,
+            "started_at": now,
+            "ended_at": None,
         }
-        self.automation_conditions[automation_id] = []  # 初始化条件ID列表
+        self.latest_run[automation_id] = key
 
-    def record_condition(self, automation_id: str, condition_event_id: int, result: bool) -> None:
+    def record_condition(self, automation_id: str, condition_event_id: int, result: bool, context: Any = None) -> None:
         """记录条件检查结果，维护完整条件链"""
-        if automation_id not in self.automation_states:
+        state = self._resolve(automation_id, context)
+        if state is None:
             _LOGGER.warning(
                 f"Automation {automation_id} not active when recording condition")
             return
 
-        state = self.automation_states[automation_id]
         state["last_condition_id"] = condition_event_id
         state["condition_passed"] = state["condition_passed"] and result
         state["current_step"] = "condition"
         # 存储所有条件ID（无论是否通过）
-        self.automation_conditions[automation_id].append(condition_event_id)
+        state["conditions"].append(condition_event_id)
 
-    def set_target_activity(self, automation_id: str, activity_id: int) -> None:
+    def set_target_activity(self, automation_id: str, activity_id: int, context: Any = None) -> None:
         """记录自动化触发的目标Command ID"""
-        if automation_id in self.automation_states:
-            self.automation_states[automation_id]["target_activity"] = activity_id
+        state = self._resolve(automation_id, context)
+        if state is not None:
+            state["target_activity"] = activity_id
 
-    def get_conditions(self, automation_id: str) -> List[int]:
-        """获取自动化的所有条件事件ID"""
-        return self.automation_conditions.get(automation_id, [])
+    def get_conditions(self, automation_id: str, context: Any = None) -> List[int]:
+        """获取本次运行的所有条件事件ID"""
+        state = self._resolve(automation_id, context)
+        return list(state["conditions"]) if state else []
 
-    def is_automation_active(self, automation_id: str) -> bool:
+    def is_automation_active(self, automation_id: str, context: Any = None) -> bool:
         """检查自动化是否仍在活跃状态（条件未失败）"""
-        state = self.automation_states.get(automation_id, {})
+        state = self._resolve(automation_id, context) or {}
         return state.get("active", False) and state.get("condition_passed", False)
 
-    def is_automation_active_with_reason(self, automation_id: str) -> Tuple[bool, Optional[int]]:
+    def is_automation_active_with_reason(self, automation_id: str, context: Any = None) -> Tuple[bool, Optional[int]]:
         """检查自动化是否活跃并返回阻塞原因ID"""
-        state = self.automation_states.get(automation_id, {})
+        state = self._resolve(automation_id, context) or {}
         is_active = state.get("active", False) and state.get(
             "condition_passed", False)
         return is_active, state.get("last_condition_id") if not is_active else None
 
-    def end_automation(self, automation_id: str) -> None:
-        """标记自动化执行结束"""
-        if automation_id in self.automation_states:
-            self.automation_states[automation_id]["active"] = False
-            self.automation_states[automation_id]["current_step"] = "completed"
+    def end_automation(self, automation_id: str, context: Any = None) -> None:
+        """标记自动化执行结束 (结束后的运行在 run_ttl 后被淘汰)"""
+        state = self._resolve(automation_id, context)
+        if state is not None:
+            state["active"] = False
+            state["current_step"] = "completed"
+            state["ended_at"] = time.monotonic()
 
-    def get_automation_context(self, automation_id: str) -> Optional[Dict[str, Any]]:
+    def get_automation_context(self, automation_id: str, context: Any = None) -> Optional[Dict[str, Any]]:
         """获取自动化上下文信息"""
-        return self.automation_states.get(automation_id)
+        return self._resolve(automation_id, context)
+
+    def clear(self) -> None:
+        self.runs.clear()
+        self.latest_run.clear()
+        self.automation_commands.clear()
 
     def track_commands(self, automation_id: str, sequence: Sequence[dict]) -> None:
         """解析自动化的动作配置，提取目标设备和命令"""
@@ -120,7 +534,7 @@ class StateMachine:
         # 存储解析后的命令，关联到自动化ID
         # 强制将 ID 转为字符串存储，防止类型不匹配
         self.automation_commands[str(automation_id)] = parsed_commands
-        _LOGGER.warning(f"[Trace] Tracked {len(parsed_commands)} commands for {automation_id}")
+        _LOGGER.debug("[Trace] Tracked %d commands for %s", len(parsed_commands), automation_id)
         #self.automation_commands[automation_id] = parsed_commands
 
     
@@ -144,29 +558,99 @@ def get_session_id() -> str:
 
 def clear_log() -> None:
     """清除事件日志并重置会话"""
-    global event_log, event_id_counter, context_id_map
-    event_log = []
+    global event_id_counter, _session_stamp
+    # 先把上一会话未落盘的事件写完，再开启新的分段日志
+    drain_pending()
+    event_log.flush()
+    event_log.clear()
     event_id_counter = 1
-    context_id_map = {}
+    context_id_map.clear()
+    _log_writers.clear()
+    _session_stamp = _new_session_stamp(_session_stamp)
+    # 封存段改写到新会话的分段日志 (旧 writer 的 last_event_id 会跳过从 1 重新编号的事件)
+    event_log.sink = get_log_writer(_spill_dir).append if _spill_dir else None
     # 重置上下文变量（保留结构，清空内容）
     vars = context_vars.get()
     vars.clear()
     context_vars.set(vars)
-    # 重置状态机
-    state_machine.automation_states.clear()
-    state_machine.automation_commands.clear()
-    state_machine.automation_conditions.clear()
+    # 重置状态机与采样状态 (无损实体登记保留)
+    state_machine.clear()
+    event_policy.clear()
     _LOGGER.info("Event log cleared and new session started")
 
 
 
+# ========== 实体元数据缓存 ==========
+# 注册表极少变化，查表结果按 entity_id 缓存，收到注册表更新事件时失效；state 中的 friendly_name 不缓存，每次现读
+EVENT_ENTITY_REGISTRY_UPDATED = "entity_registry_updated"
+EVENT_DEVICE_REGISTRY_UPDATED = "device_registry_updated"
+ENTITY_CACHE_CAPACITY = 4096
+
+_entity_info_cache = BoundedMap(ENTITY_CACHE_CAPACITY)    # entity_id -> 注册表派生信息
+_friendly_name_cache = BoundedMap(ENTITY_CACHE_CAPACITY)  # entity_id -> 降级名称
+_device_entities: Dict[str, set] = {}                      # device_id -> {entity_id}
+
+
+def invalidate_entity_cache(entity_id: Optional[str] = None, device_id: Optional[str] = None) -> None:
+    """使缓存失效：指定 entity_id / device_id 时只清理相关条目，否则全部清空"""
+    if entity_id is None and device_id is None:
+        _entity_info_cache.clear()
+        _friendly_name_cache.clear()
+        _device_entities.clear()
+        return
+    targets = set(_device_entities.pop(device_id, ())) if device_id else set()
+    if entity_id:
+        targets.add(entity_id)
+    for eid in targets:
+        _entity_info_cache.pop(eid, None)
+        _friendly_name_cache.pop(eid, None)
+
+
+def _on_entity_registry_updated(event: Any) -> None:
+    data = event.data or {}
+    invalidate_entity_cache(entity_id=data.get("entity_id"))
+    if data.get("old_entity_id"):
+        invalidate_entity_cache(entity_id=data["old_entity_id"])
+
+
+def _on_device_registry_updated(event: Any) -> None:
+    device_id = (event.data or {}).get("device_id")
+    if device_id:
+        invalidate_entity_cache(device_id=device_id)
+    else:
+        invalidate_entity_cache()
+
+
+def _subscribe_registry_updates(hass: Any) -> None:
+    """订阅注册表更新事件 (call_soon_threadsafe：事件循环内外调用都不会阻塞)"""
+    try:
+        from homeassistant.core import callback
+        hass.loop.call_soon_threadsafe(hass.bus.async_listen, EVENT_ENTITY_REGISTRY_UPDATED, callback(_on_entity_registry_updated))
+        hass.loop.call_soon_threadsafe(hass.bus.async_listen, EVENT_DEVICE_REGISTRY_UPDATED, callback(_on_device_registry_updated))
+    except Exception as e:
+        _LOGGER.error(f"Failed to subscribe registry updates: {e}")
+
+
 # ========== 核心优化：富语义信息获取 ==========
 def get_rich_entity_info(entity_id: str) -> dict:
-    """获取实体名称、区域、型号等富语义信息，解决‘脏数据’问题"""
-    # 引入注册表以获取富语义信息
-    from homeassistant.helpers import entity_registry as er
-    from homeassistant.helpers import device_registry as dr
-    
+    """获取实体名称、区域、型号等富语义信息，解决‘脏数据’问题
+    (只缓存注册表派生的字段；state 中的 friendly_name 每次现读，customize / 属性改名立即生效。返回新 dict，可随意修改)"""
+    info = _entity_info_cache.get(entity_id)
+    state = None
+    if info is None:
+        info, state = _lookup_registry_info(entity_id)
+    elif _HASS_REF:
+        state = _HASS_REF.states.get(entity_id)
+    info = dict(info)
+
+    # 尝试从 State 获取 (运行时名称通常最准)
+    if state and "friendly_name" in state.attributes:
+        info["friendly_name"] = state.attributes["friendly_name"]
+    return info
+
+
+def _lookup_registry_info(entity_id: str):
+    """查注册表得到名称 / 区域 / 型号，返回 (info, state)；实体已加载时缓存 info"""
     info = {
         "friendly_name": entity_id.split('.')[-1].replace('_', ' ').title(),
         "area_id": None,
@@ -175,7 +659,11 @@ def get_rich_entity_info(entity_id: str) -> dict:
     }
     
     if not _HASS_REF or not entity_id:
-        return info
+        return info, None
+
+    # 引入注册表以获取富语义信息
+    from homeassistant.helpers import entity_registry as er
+    from homeassistant.helpers import device_registry as dr
 
     try:
         ent_reg = er.async_get(_HASS_REF)
@@ -191,6 +679,7 @@ def get_rich_entity_info(entity_id: str) -> dict:
             
             # 2. 查询 Device Registry
             if entry.device_id:
+                _device_entities.setdefault(entry.device_id, set()).add(entity_id)
                 device = dev_reg.async_get(entry.device_id)
                 if device:
                     info["model"] = device.model
@@ -198,12 +687,219 @@ def get_rich_entity_info(entity_id: str) -> dict:
     except Exception:
         pass # 查表失败降级处理
 
-    # 3. 尝试从 State 获取 (运行时名称通常最准)
+    # 实体尚未加载 (无 state) 时不缓存，避免启动阶段缓存到降级名称
     state = _HASS_REF.states.get(entity_id)
-    if state and "friendly_name" in state.attributes:
-        info["friendly_name"] = state.attributes["friendly_name"]
+    if state is not None:
+        _entity_info_cache[entity_id] = info
+    return info, state
+
+
+# ========== 高频实体事件的采样 / 限流策略 ==========
+# domains / entities 下的规则字段：
+#   min_interval   同一实体两次记录的最小间隔 (秒)，窗口内的变化合并为一条摘要
+#   deadband       数值状态相对上次记录值的绝对变化小于该值时丢弃
+#   deadband_ratio 数值状态的相对变化小于该比例时丢弃
+# 被自动化触发/条件引用的实体、以及由命令引起 (有 source) 的状态变化始终无损记录
+DEFAULT_EVENT_POLICY: Dict[str, Any] = {
+    "enabled": True,
+    "domains": {
+        "sensor": {"min_interval": 5.0, "deadband_ratio": 0.05},
+    },
+    "entities": {
+        "sensor.cuco_v3_6df1_electric_power": {"min_interval": 30.0, "deadband": 10.0},
+    },
+}
+
+
+def _as_number(value: Any) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class EventPolicy:
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        self.configure(config or DEFAULT_EVENT_POLICY)
+        self.protected: set = set()
+        self.dropped = 0
+        # entity_id -> {"time": 上次记录时刻, "value": 上次记录的状态 (死区参考值), "pending": 被合并的变化摘要}
+        # pending["window"]：是否有非死区变化因 min_interval 窗口被压下 (只有这种情况需要在窗口结束时补记)
+        self._last: Dict[str, Dict[str, Any]] = {}
+
+    def configure(self, config: Dict[str, Any]) -> None:
+        self.enabled = config.get("enabled", True)
+        self.domains = dict(config.get("domains", {}))
+        self.entities = dict(config.get("entities", {}))
+
+    def protect(self, entity_ids: Any) -> None:
+        """登记需要无损记录的实体 (自动化触发 / 条件引用)"""
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        for eid in entity_ids or ():
+            if eid:
+                self.protected.add(eid)
+                self._last.pop(eid, None)
+
+    def rule_for(self, entity_id: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled or not entity_id or entity_id in self.protected:
+            return None
+        return self.entities.get(entity_id) or self.domains.get(entity_id.split('.')[0])
+
+    def admit(self, entity_id: str, old_state: Any, new_state: Any, now: float) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """返回 (是否记录, 附加到该事件上的合并摘要)"""
+        rule = self.rule_for(entity_id)
+        if rule is None:
+            return True, None
+        last = self._last.get(entity_id)
+        if last is None:
+            self._last[entity_id] = {"time": now, "value": new_state, "pending": None}
+            return True, None
+
+        within = now - last["time"] < rule.get("min_interval", 0.0)
+        small = False
+        cur, ref = _as_number(new_state), _as_number(last["value"])
+        if cur is not None and ref is not None:
+            delta = abs(cur - ref)
+            small = delta < rule.get("deadband", 0.0) or delta < abs(ref) * rule.get("deadband_ratio", 0.0)
+
+        if within or small:
+            pending = last["pending"]
+            if pending is None:
+                pending = last["pending"] = {"count": 0, "min": None, "max": None, "first_old": old_state, "window": False,
+                                             "since": datetime.now().strftime("%H:%M:%S.%f")[:-3]}
+            pending["count"] += 1
+            pending["last_new"] = new_state
+            # 死区内的小变化只并入下一条记录的摘要；窗口内的显著变化才需要窗口结束时补记
+            last["schedule"] = not small and not pending["window"]
+            if not small: pending["window"] = True
+            if cur is not None:
+                pending["min"] = cur if pending["min"] is None else min(pending["min"], cur)
+                pending["max"] = cur if pending["max"] is None else max(pending["max"], cur)
+            self.dropped += 1
+            return False, None
+
+        last["time"], last["value"] = now, new_state
+        return True, self._summary(last)
+
+    def _summary(self, last: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        pending, last["pending"] = last["pending"], None
+        if not pending:
+            return None
+        summary = {"coalesced_count": pending["count"], "coalesced_since": pending["since"]}
+        if pending["min"] is not None:
+            summary["coalesced_min"], summary["coalesced_max"] = pending["min"], pending["max"]
+        return summary
+
+    def take_pending(self, entity_id: str, now: float) -> Optional[Dict[str, Any]]:
+        """窗口结束时取出被合并的变化，用于补记一条摘要事件 (只有死区内小变化时不补记，参考值保持不动)"""
+        last = self._last.get(entity_id)
+        if not last or not last["pending"] or not last["pending"]["window"]:
+            return None
+        pending = last["pending"]
+        last["time"], last["value"] = now, pending["last_new"]
+        summary = self._summary(last)
+        summary.update({"old_state": pending["first_old"], "new_state": pending["last_new"]})
+        return summary
+
+    def burst_started(self, entity_id: str) -> bool:
+        """刚被丢弃的是否为窗口内第一条显著变化 (需要安排窗口结束时的补记)"""
+        last = self._last.get(entity_id)
+        return bool(last and last.pop("schedule", False))
+
+    def pending_entities(self) -> List[str]:
+        return [eid for eid, last in self._last.items() if last["pending"] and last["pending"]["window"]]
+
+    def flush_delay(self, entity_id: str, now: float) -> float:
+        rule = self.rule_for(entity_id) or {}
+        last = self._last.get(entity_id)
+        return max(0.0, last["time"] + rule.get("min_interval", 0.0) - now) if last else 0.0
+
+    def clear(self) -> None:
+        self._last.clear()
+        self.dropped = 0
+
+
+event_policy = EventPolicy()
+
+
+def configure_event_policy(config: Dict[str, Any]) -> None:
+    event_policy.configure(config)
+
+
+def protect_automation_entities(config: Any) -> None:
+    """从自动化配置的 trigger / condition 中提取实体并登记为无损"""
+    found: List[str] = []
+
+    def walk(node: Any, in_scope: bool) -> None:
+        if isinstance(node, dict):
+            for k, v in node.items():
+                scope = in_scope or k in ("trigger", "triggers", "condition", "conditions")
+                if scope and k == "entity_id":
+                    found.extend([v] if isinstance(v, str) else [x for x in v if isinstance(x, str)])
+                else:
+                    walk(v, scope)
+        elif isinstance(node, list):
+            for v in node:
+                walk(v, in_scope)
+
+    walk(config, False)
+    event_policy.protect(found)
+
+
+def _protect_from_hass(hass: Any) -> None:
+    """扫描已加载的自动化配置 (尽力而为，失败时靠 log_trigger / log_condition_check 逐步登记)"""
+    try:
+        component = hass.data.get("automation")
+        for entity in getattr(component, "entities", []) or []:
+            raw = getattr(entity, "raw_config", None)
+            if raw:
+                protect_automation_entities(raw)
+    except Exception as e:
+        _LOGGER.debug("Failed to scan automation configs: %s", e)
 
-    return info
+
+# 自动化通常在 set_global_hass 之后才加载：启动完成与每次重载时重新扫描
+EVENT_AUTOMATION_RELOADED = "automation_reloaded"
+EVENT_HOMEASSISTANT_STARTED = "homeassistant_started"
+
+
+def _subscribe_automation_reloads(hass: Any) -> None:
+    try:
+        from homeassistant.core import callback
+        on_reload = callback(lambda event: _protect_from_hass(hass))
+        hass.loop.call_soon_threadsafe(hass.bus.async_listen, EVENT_AUTOMATION_RELOADED, on_reload)
+        hass.loop.call_soon_threadsafe(hass.bus.async_listen_once, EVENT_HOMEASSISTANT_STARTED, on_reload)
+    except Exception as e:
+        _LOGGER.error(f"Failed to subscribe automation reloads: {e}")
+
+
+def _schedule_coalesced_flush(entity_id: str, now: float) -> None:
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return  # 无事件循环时由 save_log 统一补记
+    loop.call_later(event_policy.flush_delay(entity_id, now), _flush_coalesced, entity_id)
+
+
+def _flush_coalesced(entity_id: str) -> None:
+    summary = event_policy.take_pending(entity_id, time.monotonic())
+    if not summary:
+        return
+    record_event(
+        event_type=EVENT_TYPE_ENTITY,
+        device=entity_id,
+        description=f"{summary['old_state']} → {summary['new_state']} (coalesced {summary['coalesced_count']})",
+        context=None,
+        entity_id=entity_id,
+        extra_attributes=summary,
+        apply_policy=False,
+    )
+
+
+def flush_coalesced_events() -> None:
+    for entity_id in event_policy.pending_entities():
+        _flush_coalesced(entity_id)
 
 
 def record_event(
@@ -219,6 +915,7 @@ def record_event(
     target_activity: Optional[int] = None,  # Agent特有：触发的Command ID
     forbidden_activity: Optional[int] = None,  # Agent特有：阻止的Command ID
     condition_ids: Optional[List[int]] = None,  # Command特有：依赖的条件ID列表
+    apply_policy: bool = True,  # 是否经过采样 / 限流策略
 ) -> int:
     """记录事件的核心函数，支持三类事件特有字段和关联逻辑"""
     global event_id_counter
@@ -241,13 +938,242 @@ def record_event(
     current_session_id = get_session_id()
 
     # 2. 解析source（优先显式传入，再 fallback 到上下文）
+    # source 与 context_id_map 必须在回调内同步确定，后续事件依赖这里的映射
     source = None
     if extra_attributes and "source" in extra_attributes:
         source = extra_attributes.pop("source")  # 提取显式source
     else:
         if context and context.parent_id:
             source = context_id_map.get(context.parent_id)
-    
+
+    # 采样 / 限流：只作用于没有因果来源的 Entity 事件，被丢弃的事件不占用事件ID
+    if apply_policy and event_type == EVENT_TYPE_ENTITY and source is None and entity_id:
+        now = time.monotonic()
+        old_state = extra_attributes.get("old_state") if extra_attributes else None
+        new_state = extra_attributes.get("new_state") if extra_attributes else None
+        admitted, summary = event_policy.admit(entity_id, old_state, new_state, now)
+        if not admitted:
+            if event_policy.burst_started(entity_id):
+                _schedule_coalesced_flush(entity_id, now)
+            return -1
+        if summary:
+            extra_attributes = dict(extra_attributes or {}, **summary)
+
+    # 3. 分配事件ID并更新映射，其余工作 (查表、构建事件) 入队交给消费者
+    event_id = event_id_counter
+    event_id_counter += 1
+    if context and hasattr(context, 'id'):
+        context_id_map[context.id] = event_id  # 上下文ID -> 事件ID
+
+    _pending_events.append((
+        event_id, datetime.now(), event_type, device, description, source, current_session_id,
+        action, context.id if context else None, context.parent_id if context else None,
+        condition, extra_attributes, entity_id, target_activity, forbidden_activity,
+        list(condition_ids) if condition_ids is not None else None,
+    ))
+    _schedule_drain()
+    return event_id
+
+
+# ========== 异步消费：入队记录 -> 事件 ==========
+# HA 回调里只分配事件ID、更新 context_id_map 并追加一个元组 (deque 的 append / popleft 是原子操作)；
+# 查表、时间格式化、事件构建与导出由事件循环上的常驻消费任务完成，
+# 每次最多处理 DRAIN_BATCH_SIZE 条，批次之间让出事件循环，突发事件不会长时间占住 HA 回调路径
+DRAIN_BATCH_SIZE = 256
+_pending_events: deque = deque()
+_drain_scheduled = False
+_consumer_task: Optional[asyncio.Task] = None
+_consumer_wakeup: Optional[asyncio.Event] = None
+
+
+def _wake_consumer() -> None:
+    """在事件循环线程内唤醒消费任务 (任务不存在、已结束或属于另一个事件循环时重新创建)"""
+    global _consumer_task, _consumer_wakeup
+    loop = asyncio.get_running_loop()
+    if _consumer_task is None or _consumer_task.done() or _consumer_task.get_loop() is not loop:
+        _consumer_wakeup = asyncio.Event()
+        _consumer_task = loop.create_task(_consume_pending(_consumer_wakeup))
+    _consumer_wakeup.set()
+
+
+async def _consume_pending(wakeup: asyncio.Event) -> None:
+    while True:
+        await wakeup.wait()
+        wakeup.clear()
+        while _pending_events:
+            drain_pending(DRAIN_BATCH_SIZE)
+            await asyncio.sleep(0)
+
+
+def _schedule_drain() -> None:
+    global _drain_scheduled
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is not None:
+        _wake_consumer()
+    elif _HASS_REF is not None and getattr(_HASS_REF, "loop", None) is not None:
+        # 来自执行器线程的调用，转交给 HA 事件循环 (已有未处理的唤醒时不再重复投递)
+        if _drain_scheduled:
+            return
+        _drain_scheduled = True
+        _HASS_REF.loop.call_soon_threadsafe(_wake_consumer)
+    else:
+        # 没有事件循环 (启动阶段 / 离线回放)，直接同步处理
+        drain_pending()
+
+
+def drain_pending(limit: Optional[int] = None) -> int:
+    """把排队的记录构建成事件写入 event_log (limit 为本次最多处理条数，None 为全部)，返回处理条数"""
+    global _drain_scheduled
+    _drain_scheduled = False
+    batch = []
+    n = 0
+    while _pending_events and (limit is None or n < limit):
+        item = _pending_events.popleft()
+        n += 1
+        try:
+            event = _build_event(*item)
+        except Exception as e:
+            _LOGGER.error(f"Failed to build provenance event {item[0]}: {e}")
+            continue
+        event_log.append(event)
+        batch.append(event)
+    if batch and _exporter is not None:
+        _exporter.publish(batch)
+    return len(batch)
+
+
+# ========== 实时导出：本地 socket 推送 ==========
+# 协议：每行一个 JSON 消息
+#   {"type": "hello", "last_event_id": N}              连接建立时
+#   {"type": "events", "events": [...]}                一批新事件
+#   {"type": "gap", "first_id": a, "last_id": b}       订阅者积压过多被丢弃的区间 (可从分段日志补读)
+EXPORT_SOCKET_PATH = os.environ.get("HA_PROVENANCE_SOCKET", "/tmp/ha_provenance.sock")
+EXPORT_CLIENT_BUFFER = 256  # 每个订阅者最多积压的批次数
+
+
+class ProvenanceExporter:
+    """
+    在 HA 事件循环上运行的推送服务 (Unix socket，或指定 host/port 时监听 localhost TCP)。
+    每批事件只序列化一次；每个订阅者有独立的有界队列，由各自的写协程 await drain() 发送，
+    慢订阅者只会丢弃自己最早的积压批次 (并收到 gap 消息)，不会阻塞记录路径。
+    """
+    def __init__(self, path: str = EXPORT_SOCKET_PATH, host: Optional[str] = None, port: Optional[int] = None, max_pending: int = EXPORT_CLIENT_BUFFER):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.max_pending = max_pending
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server = None
+        self._clients: List[Dict[str, Any]] = []
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        if self.port is not None:
+            self._server = await asyncio.start_server(self._handle, self.host or "127.0.0.1", self.port)
+        else:
+            if os.path.exists(self.path):
+                os.remove(self.path)  # 上次异常退出残留的 socket 文件
+            self._server = await asyncio.start_unix_server(self._handle, self.path)
+        _LOGGER.info(f"Provenance exporter listening on {self.path if self.port is None else (self.host, self.port)}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for client in list(self._clients):
+            client["closed"] = True
+            client["wakeup"].set()
+        if self.port is None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def _line(msg: Dict[str, Any]) -> bytes:
+        return (json.dumps(msg, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        client = {"writer": writer, "queue": deque(), "wakeup": asyncio.Event(), "gap": None, "closed": False}
+        self._clients.append(client)
+        try:
+            writer.write(self._line({"type": "hello", "last_event_id": event_id_counter - 1}))
+            await writer.drain()
+            while not client["closed"]:
+                await client["wakeup"].wait()
+                client["wakeup"].clear()
+                while client["queue"] or client["gap"]:
+                    if client["gap"]:
+                        first_id, last_id = client["gap"]
+                        client["gap"] = None
+                        writer.write(self._line({"type": "gap", "first_id": first_id, "last_id": last_id}))
+                    else:
+                        writer.write(client["queue"].popleft()[2])
+                    await writer.drain()  # 背压：按订阅者自己的速度发送
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._clients.remove(client)
+            writer.close()
+
+    def publish(self, events: List[ProvEvent]) -> None:
+        """推送一批事件；可从任意线程调用"""
+        if not self._clients or self.loop is None:
+            return
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if not in_loop:
+            self.loop.call_soon_threadsafe(self.publish, events)
+            return
+        payload = self._line({"type": "events", "events": [event_as_dict(e) for e in events]})
+        item = (events[0]["event_ID"], events[-1]["event_ID"], payload)
+        for client in self._clients:
+            queue_ = client["queue"]
+            if len(queue_) >= self.max_pending:
+                first_id, last_id, _ = queue_.popleft()
+                if client["gap"]:
+                    first_id = client["gap"][0]
+                client["gap"] = (first_id, last_id)
+            queue_.append(item)
+            client["wakeup"].set()
+
+
+_exporter: Optional[ProvenanceExporter] = None
+
+
+async def async_start_exporter(path: str = EXPORT_SOCKET_PATH, host: Optional[str] = None, port: Optional[int] = None, max_pending: int = EXPORT_CLIENT_BUFFER) -> ProvenanceExporter:
+    """在当前事件循环上启动导出服务"""
+    global _exporter
+    if _exporter is not None:
+        await _exporter.stop()
+    exporter = ProvenanceExporter(path, host, port, max_pending)
+    await exporter.start()
+    _exporter = exporter
+    return exporter
+
+
+def start_exporter(hass: Any, path: str = EXPORT_SOCKET_PATH, host: Optional[str] = None, port: Optional[int] = None, max_pending: int = EXPORT_CLIENT_BUFFER) -> None:
+    """把导出服务调度到 hass.loop 上启动 (只依赖 hass.loop，可用假的 hass 对象测试)"""
+    hass.loop.call_soon_threadsafe(
+        lambda: hass.loop.create_task(async_start_exporter(path, host, port, max_pending)))
+
+
+async def async_stop_exporter() -> None:
+    global _exporter
+    if _exporter is not None:
+        await _exporter.stop()
+        _exporter = None
+
+
+def _build_event(
+    event_id: int, now: datetime, event_type: str, device: str, description: str, source: Any, session_id: str,
+    action: Optional[str], context_id: Optional[str], parent_context_id: Optional[str],
+    condition: Optional[Dict[str, Any]], extra_attributes: Optional[Dict[str, Any]], entity_id: Optional[str],
+    target_activity: Optional[int], forbidden_activity: Optional[int], condition_ids: Optional[List[int]],
+) -> ProvEvent:
     rich_info = {}
     display_name = device
     if entity_id:
@@ -258,19 +1184,19 @@ def record_event(
         display_name = rich_info.get("friendly_name", device)
 
     # 4. 构建基础事件结构
-    event = {
-        "timestamp": datetime.now().strftime("%H:%M:%S.%f")[:-3],
+    event = ProvEvent({
+        "timestamp": now.strftime("%H:%M:%S.%f")[:-3],
         "device": display_name, # 用户可见名称
         "raw_device_id": entity_id or device, # 保留技术 ID
         "event_type": event_type,
         "description": description,
         "source": source,
-        "event_ID": event_id_counter,
-        "session_id": current_session_id,
+        "event_ID": event_id,
+        "session_id": session_id,
         "action": action,
-        "context_id": context.id if context else None,
-        "parent_context_id": context.parent_id if context else None
-    }
+        "context_id": context_id,
+        "parent_context_id": parent_context_id
+    })
 
     if rich_info.get("area_id"):
         event["area"] = rich_info["area_id"]
@@ -305,37 +1231,29 @@ def record_event(
     if extra_attributes:
         event.update(extra_attributes)
 
-    # 8. 存储事件并更新映射
-    event_log.append(event)
-    if context and hasattr(context, 'id'):
-        context_id_map[context.id] = event_id_counter  # 上下文ID -> 事件ID
-
-    event_id_counter += 1
-    _LOGGER.debug(f"Recorded {event_type} event: {event}")
-    return event_id_counter - 1
+    _LOGGER.debug("Recorded %s event: %s", event_type, event)
+    return event
 
 
 def save_log(base_dir: str, prefix: str = "provenance_log") -> str:
     """
-    保存带时间戳的事件日志。
+    增量保存事件日志：把上次保存之后的新事件追加到本会话的分段 JSONL 日志。
     参数 base_dir: 存储目录，如 '/home/homeassistant/.homeassistant/logs/'
     参数 prefix: 文件名前缀
+    返回索引文件路径 (<prefix>_<会话时间戳>_index.json)
     """
     try:
-        # 1. 生成人类可读的时间戳
-        timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        filename = f"{prefix}_{timestamp}.json"
-        full_path = os.path.join(base_dir, filename)
+        # 1. 补记被合并的高频变化，处理完排队记录，并等后台线程写完已封存的段，保证 event_ID 按序落盘
+        flush_coalesced_events()
+        drain_pending()
+        event_log.flush()
 
-        # 2. 确保目录存在
-        os.makedirs(base_dir, exist_ok=True)
+        # 2. 只追加尚未写入该 writer 的事件 (O(新事件数))
+        writer = get_log_writer(base_dir, prefix)
+        written = writer.append(event_log.since(writer.last_event_id))
 
-        # 3. 写入文件
-        with open(full_path, 'w', encoding='utf-8') as f:
-            json.dump(event_log, f, indent=2, ensure_ascii=False)
-        
-        _LOGGER.warning(f"===== Provenance Log Saved: {full_path} =====")
-        return full_path
+        _LOGGER.warning(f"===== Provenance Log Saved: {writer.index_path} (+{written} events) =====")
+        return writer.index_path
     except Exception as e:
         _LOGGER.error(f"Failed to save event log: {e}")
         return ""
@@ -345,22 +1263,25 @@ def save_log(base_dir: str, prefix: str = "provenance_log") -> str:
 
 # ========== 事件记录工具函数 ==========
 def log_agent_event(device: str, description: str, context: Any, condition: Optional[Dict[str, Any]] = None, extra_attributes: Optional[Dict[str, Any]] = None, automation_id: Optional[str] = None, target_activity: Optional[int] = None, forbidden_activity: Optional[int] = None, action: Optional[str] = None) -> int:
-    _LOGGER.warning(f"Entering log_agent_event: Device={device}, Action={action}, AutoID={automation_id}")
+    _LOGGER.debug("Entering log_agent_event: Device=%s, Action=%s, AutoID=%s", device, action, automation_id)
 
+    # 条件失败的描述在入库前确定，避免封存段落盘后再修改
+    failed = bool(condition and automation_id and not condition.get("condition_result", False))
+    if failed:
+        description = f"Condition failed: {description}. Stopping automation."
     event_id = record_event(EVENT_TYPE_AGENT, device, description, context, action, condition, extra_attributes, target_activity=target_activity, forbidden_activity=forbidden_activity)
     if condition and automation_id:
         result = condition.get("condition_result", False)
-        state_machine.record_condition(str(automation_id), event_id, result)
+        state_machine.record_condition(str(automation_id), event_id, result, context)
         if not result:
-            if event_log and event_log[-1]["event_ID"] == event_id:
-                event_log[-1]["description"] = f"Condition failed: {description}. Stopping automation." 
-            _LOGGER.warning(f"[Trace] Condition Failed. Triggering block logging for {automation_id}")
+            _LOGGER.debug("[Trace] Condition Failed. Triggering block logging for %s", automation_id)
             log_blocked_commands(str(automation_id), context, event_id)
-            state_machine.end_automation(str(automation_id))
+            state_machine.end_automation(str(automation_id), context)
     return event_id
     
 def log_trigger(action: str, entity_id: str, state: str, automation_name: str, context: Any, automation_id: str, sequence: Optional[Sequence[dict]] = None, is_start_point: bool = True) -> int:
-    _LOGGER.warning(f"[Trace] Trigger Start: {automation_name} (ID: {automation_id})")
+    _LOGGER.debug("[Trace] Trigger Start: %s (ID: %s)", automation_name, automation_id)
+    event_policy.protect(entity_id)
     
     # 获取触发源 Entity 事件 ID（实现 Trigger 溯源）
     vars = context_vars.get()
@@ -380,9 +1301,9 @@ def log_trigger(action: str, entity_id: str, state: str, automation_name: str, c
         action="triggered"
     )
     # 核心修复：同时用数字 ID 和 实体名注册状态机，解决匹配不上问题
-    state_machine.start_automation(str(automation_id), agent_event_id)
+    state_machine.start_automation(str(automation_id), agent_event_id, context)
     if automation_name and automation_name.startswith("automation."):
-        state_machine.start_automation(automation_name, agent_event_id)
+        state_machine.start_automation(automation_name, agent_event_id, context)
 
 
     if sequence:
@@ -416,12 +1337,13 @@ def log_condition_check(
     condition_state: Optional[str] = None
 ) -> None:
     """记录条件检查事件（用于构建isConditionOf边）"""
-    _LOGGER.warning(f"[Trace] Condition Check: {automation_name} | ID: {automation_id} | Result: {result}")
+    _LOGGER.debug("[Trace] Condition Check: %s | ID: %s | Result: %s", automation_name, automation_id, result)
+    event_policy.protect(entity_id)
     try:
         # 即使状态机里没有 active，我们也要继续记录日志，不要 return
-        is_active = state_machine.is_automation_active(automation_id)
+        is_active = state_machine.is_automation_active(automation_id, context)
         if not is_active:
-            _LOGGER.warning(f"[Trace] ID {automation_id} not found/active in state_machine, recording anyway.")
+            _LOGGER.debug("[Trace] ID %s not found/active in state_machine, recording anyway.", automation_id)
 
         device_name = get_friendly_name(entity_id)
         condition_info = f"{condition_desc} - {'Passed' if result else 'Failed'}"
@@ -432,7 +1354,7 @@ def log_condition_check(
         trigger_source = automation_context.get("entity_event_id")
 
         # 构造 condition 详情，增加 fallback 逻辑防止 related_trigger_id 报错
-        auto_ctx = state_machine.get_automation_context(automation_id)
+        auto_ctx = state_machine.get_automation_context(automation_id, context)
         related_trigger = auto_ctx.get("trigger_event_id") if auto_ctx else None
 
         condition_data = {
@@ -455,7 +1377,7 @@ def log_condition_check(
 
         # 无论如何都要尝试记录被阻止的命令
         if not result:
-            _LOGGER.warning(f"[Trace] Condition Failed, logging blocked commands for {automation_id}")
+            _LOGGER.debug("[Trace] Condition Failed, logging blocked commands for %s", automation_id)
             log_blocked_commands(automation_id, context, condition_event_id)
     except Exception as e:
         _LOGGER.warning(f"Error in log_condition_check: {e}")
@@ -489,9 +1411,7 @@ def log_condition(
             final_id = automation_name 
             _LOGGER.debug(f"Using entity name as fallback ID: {final_id}")
 
-        # --- 强制插入 Debug 日志 ---
-        _LOGGER.warning(f"[Condition Trace] Name: {automation_name} | ID: {final_id} | Result: {result}")
-        _LOGGER.warning(f"[Trace] Entering log_condition: {automation_name} | TargetID: {final_id}")
+        _LOGGER.debug("[Condition Trace] Name: %s | ID: %s | Result: %s", automation_name, final_id, result)
 
         log_condition_check(
             automation_name=automation_name,
@@ -535,7 +1455,7 @@ def log_blocked_commands(
             description=f"Blocked: {cmd['description']}",
             context=context,
             condition_ids=state_machine.get_conditions(
-                automation_id),  # 关联所有条件ID
+                automation_id, context),  # 关联本次运行的所有条件ID
             extra_attributes={
                 "command": cmd["command"],  # 被阻止的命令（如"light.turn_on"）
                 "target_device": cmd["target_device"],  # 目标设备
@@ -602,10 +1522,9 @@ def log_command(
         description = f"{command.split('.')[-1].replace('_', ' ').title()}"
 
         # 获取依赖的条件ID列表（从状态机）
-        _LOGGER.warning("automation_id")
-        _LOGGER.warning(automation_id)
+        _LOGGER.debug("[Trace] log_command automation_id=%s", automation_id)
         condition_ids = state_machine.get_conditions(
-            automation_id) if automation_id else None
+            automation_id, context) if automation_id else None
 
         # 记录Command事件
         cmd_event_id = record_event(
@@ -631,8 +1550,8 @@ def log_command(
 
         # 关联Agent与Command（更新状态机）
         if automation_id and status == "executed":
-            state_machine.set_target_activity(automation_id, cmd_event_id)
-            state_machine.end_automation(automation_id)
+            state_machine.set_target_activity(automation_id, cmd_event_id, context)
+            state_machine.end_automation(automation_id, context)
 
         # 被阻塞时补充关联
         #if status == "blocked" and blocked_by:
@@ -650,8 +1569,8 @@ def get_friendly_name(entity_id: str) -> str:
     """从全局 HASS 引用中获取友好名称，支持无 HASS 时的降级处理"""
     if not entity_id:
         return "Unknown"
-    
-    # 1. 如果全局 HASS 引用存在，尝试从状态机获取
+    # 1. 如果全局 HASS 引用存在，尝试从状态机获取 (每次现读，customize / 属性改名立即生效)
+    state = None
     if _HASS_REF:
         state = _HASS_REF.states.get(entity_id)
         if state and "friendly_name" in state.attributes:
@@ -663,15 +1582,22 @@ def get_friendly_name(entity_id: str) -> str:
         # entry = registry.async_get(entity_id)
         # if entry and entry.name: return entry.name
     
-    # 3. 降级处理：将 input_boolean.system_armed 变为 System Armed
-    return entity_id.split('.')[-1].replace('_', ' ').title()
+    # 3. 降级处理：将 input_boolean.system_armed 变为 System Armed (只缓存这个派生名称)
+    cached = _friendly_name_cache.get(entity_id)
+    if cached is not None:
+        return cached
+    name = entity_id.split('.')[-1].replace('_', ' ').title()
+    if state is not None:
+        _friendly_name_cache[entity_id] = name
+    return name
     
 
-def init_startup_log():
+def init_startup_log(spill_dir: Optional[str] = DEFAULT_SPILL_DIR):
     """初始化新日志会话"""
     try:
-        # 1. 重置全局变量和状态机
-        clear_log() 
+        # 1. 重置全局变量和状态机，并配置封存段落盘目录
+        clear_log()
+        configure_event_store(spill_dir=spill_dir)
         
         # 2. 记录系统启动事件作为 Log 的第一条数据
         record_event(
@@ -22,6 +22,7 @@ if project_root not in sys.path:
 import logging
 import collections
 import bisect
+import heapq
 from datetime import datetime
 from typing import List, Dict, Set, Any
 from dsa.dsa_engine import DeviationSearchEngine
@@ -36,6 +37,15 @@ class InteractionCausalSelector:
         # 按照时间戳排序，构建时空搜索的数据底座
         self.pool = sorted(net_atomic_pool, key=lambda x: x['ts'])
         self.pool_ts = [f['ts'] for f in self.pool]
+
+        # 倒排索引 (一次构建)：net_id -> 流；IP -> 涉及该 IP 的流在 pool 中的下标 (pool 已按时间排序，下标即时间有序)
+        self._flow_ips = [frozenset(self._get_ips_from_flow(f)) for f in self.pool]
+        self.net_id_index: Dict[Any, List[Dict]] = collections.defaultdict(list)
+        self.ip_index: Dict[str, List[int]] = collections.defaultdict(list)
+        for pos, f in enumerate(self.pool):
+            self.net_id_index[f.get('net_id')].append(f)
+            for ip in self._flow_ips[pos]:
+                self.ip_index[ip].append(pos)
         
         # 拓扑角色定义 (Topological Roles)
         self.control_plane_ip = control_plane_ip  # 控制面中心 (HA/Gateway)
@@ -55,6 +65,12 @@ class InteractionCausalSelector:
         if 'target_ip' in flow: ips.add(flow['target_ip'])
         return ips
 
+    def _ip_positions(self, ip: str, start: int, end: int) -> List[int]:
+        """涉及 ip 且位于 pool[start:end] 的流下标"""
+        positions = self.ip_index.get(ip)
+        if not positions: return []
+        return positions[bisect.bisect_left(positions, start):bisect.bisect_left(positions, end)]
+
     def slice_causal_subgraph(self, primitive: Dict[str, Any], max_hops: int = 1) -> Dict[str, Any]:
         t0 = primitive['timestamp']
         p_type = primitive.get('type')
@@ -72,7 +88,7 @@ class InteractionCausalSelector:
             # [物理层已证实]: 直接使用底层 Net Atomic 作为因果种子
             phys_id = primitive.get('physical_id')
             if phys_id:
-                seeds =[f for f in self.pool if f.get('net_id') == phys_id]
+                seeds = list(self.net_id_index.get(phys_id, []))
                 
         elif p_type == "UNSUPPORTED":
             # [因果断裂 / 物理层虚无]: 触发 Control-Plane Anchoring (控制面锚点回溯)
@@ -80,17 +96,18 @@ class InteractionCausalSelector:
             idx_end = bisect.bisect_right(self.pool_ts, t0 + self.base_window)
             
             # 1. 常规数据面拾遗
-            for f in self.pool[idx_start:idx_end]:
-                f_ips = self._get_ips_from_flow(f)
-                if (target_device_ip != "Null" and target_device_ip in f_ips) or (entity_id in f.get('label', '')):
-                    seeds.append(f)
+            seed_pos = set()
+            for pos in range(idx_start, idx_end):
+                f = self.pool[pos]
+                if (target_device_ip != "Null" and target_device_ip in self._flow_ips[pos]) or (entity_id in f.get('label', '')):
+                    seeds.append(f); seed_pos.add(pos)
             
             # 2. 控制面恶意注入回溯 (Cyber Event Injection)
             n_start = bisect.bisect_left(self.pool_ts, t0 - self.anchor_window)
             n_end = bisect.bisect_right(self.pool_ts, t0 + self.anchor_window)
-            for f in self.pool[n_start:n_end]:
-                if f in seeds: continue
-                f_ips = self._get_ips_from_flow(f)
+            for pos in range(n_start, n_end):
+                if pos in seed_pos: continue
+                f, f_ips = self.pool[pos], self._flow_ips[pos]
                 
                 # 约束：涉及控制平面，但不涉及目标设备，且未被认证(Unknown)
                 if self.control_plane_ip in f_ips and target_device_ip not in f_ips:
@@ -118,16 +135,24 @@ class InteractionCausalSelector:
                 c_start = bisect.bisect_left(self.pool_ts, seed_ts - 2.0)
                 c_end = bisect.bisect_right(self.pool_ts, seed_ts + 5.0) 
                 
-                for candidate in self.pool[c_start:c_end]:
+                # 拓扑连通性约束：只访问窗口内涉及已追踪 IP 的流 (按 pool 顺序)；
+                # 新纳入追踪的 IP 只补充当前位置之后的流，与顺序扫描窗口的结果一致
+                heap = sorted({p for ip in tracked_ips for p in self._ip_positions(ip, c_start, c_end)})
+                queued = set(heap)
+                while heap:
+                    pos = heapq.heappop(heap)
+                    candidate = self.pool[pos]
                     cid = candidate['net_id']
                     if cid in expanded_set: continue
-                    
-                    can_ips = self._get_ips_from_flow(candidate)
-                    # 拓扑连通性约束
-                    if tracked_ips.intersection(can_ips):
-                        expanded_set[cid] = candidate
-                        next_wave.append(candidate)
-                        tracked_ips.update(can_ips - {self.gateway_ip, "Null"})
+
+                    can_ips = self._flow_ips[pos]
+                    expanded_set[cid] = candidate
+                    next_wave.append(candidate)
+                    new_ips = can_ips - {self.gateway_ip, "Null"} - tracked_ips
+                    tracked_ips.update(new_ips)
+                    for ip in new_ips:
+                        for p in self._ip_positions(ip, pos + 1, c_end):
+                            if p not in queued: queued.add(p); heapq.heappush(heap, p)
             
             if not next_wave: break
             current_wave = next_wave
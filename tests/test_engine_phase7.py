@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Phase 7 影子通路：默认不限制通路长度 (与原始 all_simple_paths 搜索一致)"""
+import contextlib
+import io
+import os
+import sys
+
+import networkx as nx
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from LE.core.engine import LogicEngine
+
+
+def _engine(path_len, config=None):
+    G = nx.DiGraph()
+    G.add_node("a", kind="Entity"); G.add_node("b", kind="Entity")
+    G.add_edge("a", "b", type="Derive", label="Derive")
+    chain = ["a", "Ghost_1"] + [f"n{i}" for i in range(path_len - 2)] + ["b"]
+    for n in chain[1:-1]: G.add_node(n, kind="GhostEntity" if n.startswith("Ghost") else "Entity")
+    for u, v in zip(chain, chain[1:]): G.add_edge(u, v, type="shouldDerive", label="shouldDerive")
+    return LogicEngine(G, [], [], config)
+
+
+def _suppressed(eng):
+    with contextlib.redirect_stdout(io.StringIO()):
+        eng.phase_7_conflict_resolution()
+    return eng.G.edges["a", "b"]["type"] == "suppressed"
+
+
+def test_long_shadow_path_suppresses_derive_by_default():
+    assert _suppressed(_engine(15))
+
+
+def test_shadow_path_cutoff_is_opt_in():
+    assert not _suppressed(_engine(15, {"shadow_path_cutoff": 10}))
+    assert _suppressed(_engine(8, {"shadow_path_cutoff": 10}))
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""ha-provenance 采样 / 限流策略：按实际落盘的事件数校验 (不只看 dropped 计数)"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+provenance_dir = os.path.join(project_root, "ha-provenance", "scripts")
+if provenance_dir not in sys.path:
+    sys.path.append(provenance_dir)
+
+import provenance as P
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = FakeClock()
+    monkeypatch.setattr(P.time, "monotonic", c.monotonic)
+    P.init_startup_log(spill_dir="")
+    P.event_policy.clear()
+    P.event_policy.protected.clear()
+    P.configure_event_policy({"domains": {"sensor": {"min_interval": 5.0, "deadband_ratio": 0.05}}})
+    yield c
+    P.configure_event_policy(P.DEFAULT_EVENT_POLICY)
+    P.event_policy.clear()
+    P.event_policy.protected.clear()
+
+
+def _record(entity_id, old, new):
+    return P.record_event(event_type=P.EVENT_TYPE_ENTITY, device=entity_id, description=f"{old} → {new}",
+                          context=None, entity_id=entity_id, extra_attributes={"old_state": old, "new_state": new})
+
+
+def _recorded(entity_id):
+    P.drain_pending()
+    return [e for e in P.event_log.snapshot() if e.get("entity_id") == entity_id]
+
+
+def test_deadband_drops_are_not_written(clock):
+    async def main():
+        values = ["100", "101", "102", "101.5", "100.7", "101.2"]
+        prev = "99"
+        for v in values:
+            _record("sensor.temp", prev, v); prev = v
+            clock.now += 6.0
+            await asyncio.sleep(0)  # 让可能被安排的补记回调执行
+        await asyncio.sleep(0)
+    asyncio.run(main())
+
+    events = _recorded("sensor.temp")
+    assert len(events) == 1
+    assert P.event_policy.dropped == 5
+    # 参考值仍是已记录的 100：104 相对 100 仍在 5% 死区内
+    _record("sensor.temp", "101.2", "104")
+    assert len(_recorded("sensor.temp")) == 1
+    # 显著变化被记录，并带上之前死区内变化的摘要
+    _record("sensor.temp", "104", "120")
+    events = _recorded("sensor.temp")
+    assert len(events) == 2
+    assert events[-1]["coalesced_count"] == 6
+    assert events[-1]["coalesced_min"] == 100.7 and events[-1]["coalesced_max"] == 104.0
+
+    P.flush_coalesced_events()
+    assert len(_recorded("sensor.temp")) == 2
+
+
+def test_window_suppressed_change_is_flushed_once(clock):
+    _record("sensor.power", "0", "100")
+    clock.now += 1.0
+    _record("sensor.power", "100", "200")   # 窗口内的显著变化
+    clock.now += 1.0
+    _record("sensor.power", "200", "201")   # 死区内
+    assert len(_recorded("sensor.power")) == 1
+
+    P.flush_coalesced_events()
+    events = _recorded("sensor.power")
+    assert len(events) == 2
+    assert events[-1]["coalesced_count"] == 2 and events[-1]["new_state"] == "201"
+    P.flush_coalesced_events()
+    assert len(_recorded("sensor.power")) == 2
+
+
+
+def test_clear_log_rebinds_spill_sink(tmp_path):
+    P.configure_event_store(spill_dir="")
+    P.clear_log()
+    P.configure_event_store(segment_size=2, spill_dir=str(tmp_path))
+    try:
+        for i in range(4):
+            P.record_event(event_type=P.EVENT_TYPE_AGENT, device="System", description=f"a{i}", context=None)
+        P.drain_pending(); P.event_log.flush()
+        P.clear_log()   # 不经过 init_startup_log，直接开启新会话
+        for i in range(4):
+            P.record_event(event_type=P.EVENT_TYPE_AGENT, device="System", description=f"b{i}", context=None)
+        P.drain_pending(); P.event_log.flush()
+
+        indexes = sorted(tmp_path.glob("*_index.json"))
+        assert len(indexes) == 2
+        from tool.provlog import load_provenance_events
+        sessions = [[e["description"] for e in load_provenance_events(str(p))] for p in indexes]
+        assert sorted(sessions) == [["a0", "a1", "a2", "a3"], ["b0", "b1", "b2", "b3"]]
+    finally:
+        P.configure_event_store(segment_size=P.EVENT_SEGMENT_SIZE, spill_dir="")
+
+
+def test_burst_is_drained_in_bounded_batches():
+    P.configure_event_store(spill_dir="")
+    P.clear_log()
+
+    async def main():
+        n = P.DRAIN_BATCH_SIZE * 2 + 10
+        ids = [P.record_event(event_type=P.EVENT_TYPE_AGENT, device="System", description=f"e{i}", context=None)
+               for i in range(n)]
+        # 回调路径上只入队，事件构建留给消费任务
+        assert len(P.event_log) == 0 and len(P._pending_events) == n
+        await asyncio.sleep(0)
+        assert 0 < len(P.event_log) <= P.DRAIN_BATCH_SIZE   # 每批之后让出事件循环
+        for _ in range(10):
+            await asyncio.sleep(0)
+        return ids
+    ids = asyncio.run(main())
+
+    events = P.event_log.snapshot()
+    assert not P._pending_events
+    assert [e["event_ID"] for e in events] == ids
+
+
+class _State:
+    def __init__(self, **attributes):
+        self.attributes = attributes
+
+
+class _Hass:
+    def __init__(self, states):
+        self.states = states
+
+
+def test_friendly_name_follows_state_renames(monkeypatch):
+    states = {"light.lamp": _State(friendly_name="Lamp")}
+    monkeypatch.setattr(P, "_HASS_REF", _Hass(states))
+    P.invalidate_entity_cache()
+    # 注册表派生字段已缓存 (相当于之前查过一次注册表)
+    P._entity_info_cache["light.lamp"] = {"friendly_name": "Lamp Entry", "area_id": "living_room",
+                                          "model": "LX1", "domain": "light"}
+    try:
+        assert P.get_friendly_name("light.lamp") == "Lamp"
+        assert P.get_rich_entity_info("light.lamp")["friendly_name"] == "Lamp"
+        # customize / 属性改名不经过注册表事件，也要立即生效
+        states["light.lamp"] = _State(friendly_name="Reading Lamp")
+        assert P.get_friendly_name("light.lamp") == "Reading Lamp"
+        info = P.get_rich_entity_info("light.lamp")
+        assert info["friendly_name"] == "Reading Lamp" and info["area_id"] == "living_room"
+        # 返回的是副本，调用方修改不会污染缓存
+        info["area_id"] = "garage"
+        assert P.get_rich_entity_info("light.lamp")["area_id"] == "living_room"
+    finally:
+        P.invalidate_entity_cache()
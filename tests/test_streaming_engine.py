@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""流式引擎与批处理 run() 的等价性：wasAssociateWith 边晚于其 Activity 到达"""
+import contextlib
+import io
+import os
+import sys
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from LE.core.engine import LogicEngine, StreamingLogicEngine, load_g6_graph
+
+RULES = [
+    # 按 command 命中的规则排在前面：没有 wasAssociateWith 边时 Activity 落到这条规则上
+    {"id": "fallback", "alias": "Fallback", "trigger": {"entity_id": "sensor.y", "to": "on"},
+     "action": {"command": "light.turn_on"}},
+    {"id": "auto1", "alias": "Motion Light", "trigger": {"entity_id": "sensor.x", "to": "on"},
+     "action": {"command": "light.turn_on"}},
+]
+NODES = [
+    {"id": "Ghost_x", "kind": "GhostEntity", "entity_id": "sensor.x", "new_state": "on", "state": "on",
+     "timestamp": "2025-01-01T10:00:00.000"},
+    {"id": "Ghost_y", "kind": "GhostEntity", "entity_id": "sensor.y", "new_state": "on", "state": "on",
+     "timestamp": "2025-01-01T10:00:00.100"},
+    {"id": "Agent_1", "kind": "Agent", "device": "Motion Light", "automation_id": "auto1",
+     "timestamp": "2025-01-01T10:00:00.200"},
+    {"id": "Command_2", "kind": "Activity", "command": "light.turn_on", "target_device": "light.lamp",
+     "status": "executed", "timestamp": "2025-01-01T10:00:01.000"},
+]
+LINKS = [{"source": "Agent_1", "target": "Command_2", "type": "wasAssociateWith"}]
+
+
+def _should_advance(G):
+    return {(u, v) for u, v, d in G.edges(data=True) if d.get("type") == "shouldAdvance"}
+
+
+def _batch(tmp_path):
+    import json
+    path = tmp_path / "g.json"
+    path.write_text(json.dumps({"nodes": NODES, "links": LINKS}))
+    with contextlib.redirect_stdout(io.StringIO()):
+        return LogicEngine(load_g6_graph(str(path)), [], {"rules": RULES}).run()
+
+
+def test_late_was_associate_with_edge_reindexes_activity(tmp_path):
+    expected = _should_advance(_batch(tmp_path))
+    assert expected == {("Ghost_x", "Command_2")}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        eng = StreamingLogicEngine({"rules": RULES})
+        eng.push_nodes(NODES)
+        first = eng.flush()
+        eng.push_nodes([], LINKS)   # 边在后一批到达
+        later = eng.flush() + eng.close()
+    assert _should_advance(eng.G) == expected
+    # 第一批按 command 规则给出的 shouldAdvance 在边到达后被撤回
+    assert {"source": "Ghost_y", "target": "Command_2", "type": "shouldAdvance", "label": "shouldAdvance"} in first
+    assert {"source": "Ghost_y", "target": "Command_2", "type": "retracted", "label": "retracted (shouldAdvance)"} in later
+
+
+def test_derive_edge_before_its_target_node_stays_live():
+    a = {"id": "Entity_a", "kind": "Entity", "entity_id": "light.lamp", "new_state": "off", "timestamp": "2025-01-01T10:00:00.000"}
+    b = {"id": "Entity_b", "kind": "Entity", "entity_id": "light.lamp", "new_state": "on", "timestamp": "2025-01-01T10:00:05.000"}
+    with contextlib.redirect_stdout(io.StringIO()):
+        eng = StreamingLogicEngine({"rules": RULES})
+        eng.push_nodes([a], [{"source": "Entity_a", "target": "Entity_b", "type": "Derive"}])
+        eng.flush()
+        eng.push_nodes([b])
+        assert ("Entity_a", "Entity_b") in eng._live_derives
+        eng.flush()
+    assert eng._live_derives[("Entity_a", "Entity_b")] == eng.G.nodes["Entity_b"]["_dt"]
+
+
+def test_offset_aware_timestamps():
+    nodes = [{**n, "timestamp": n["timestamp"] + "+08:00"} for n in NODES]
+    with contextlib.redirect_stdout(io.StringIO()):
+        eng = StreamingLogicEngine({"rules": RULES})
+        eng.push_nodes(nodes[:2])
+        eng.push_primitives([{"type": "MATCHED", "timestamp": "2025-01-01T10:00:00.500+08:00"}])
+        eng.flush()
+        eng.push_nodes(nodes[2:], LINKS)
+        eng.flush()
+        eng.close()
+    assert eng.watermark.tzinfo is not None
+    assert ("Ghost_x", "Command_2") in _should_advance(eng.G)
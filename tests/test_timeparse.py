@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""时间戳解析：交替出现的 ISO / 只有时分秒的时间戳必须按原优先级解析"""
+import os
+import sys
+from datetime import datetime
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from tool.timeparse import TimestampParser, parse_iso
+from LE.core.engine import parse_dt
+
+
+def test_le_parse_dt_interleaved_iso_and_clock():
+    values = ["10:00:00.500", "2025-03-03T11:00:00.500", "12:00:00.250", "2025-03-04 09:30:00.000", "2025-03-03T11:00:00.500"]
+    expected = [datetime(2024, 1, 1, 10, 0, 0, 500000), datetime(2025, 3, 3, 11, 0, 0, 500000),
+                datetime(2024, 1, 1, 12, 0, 0, 250000), datetime(2025, 3, 4, 9, 30), datetime(2025, 3, 3, 11, 0, 0, 500000)]
+    assert [parse_dt(v) for v in values] == expected
+
+
+def test_non_exclusive_parser_keeps_priority_order():
+    lenient = lambda s: datetime.strptime(s.split(" ")[-1], "%H:%M:%S").replace(year=2024, month=1, day=1)
+    p = TimestampParser((parse_iso, lenient))
+    assert p("08:00:00") == datetime(2024, 1, 1, 8)
+    assert p("2025-05-05 08:00:00") == datetime(2025, 5, 5, 8)
+
+
+def test_exclusive_parser_matches_priority_order():
+    formats = ("%H:%M:%S.%f", "%H:%M:%S", "%Y-%m-%d %H:%M:%S")
+    values = ["2025-01-01 00:00:01", "01:02:03", "01:02:03.5", "2025-01-02 00:00:02", "bad"]
+    a, b = TimestampParser(formats), TimestampParser(formats, exclusive=True)
+    assert [a(v) for v in values] == [b(v) for v in values]
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+溯源日志读取 (RawLogs/filter.py / appbuilder 共用)
+
+支持两种输入：
+- 分段 JSONL 日志的索引文件 <name>_index.json (ha-provenance 的 SegmentedLogWriter 写出)
+- 旧版整文件 JSON 数组 (provenance_log_<时间戳>.json / app.json)
+
+分段日志可按时间范围或 event_ID 范围只读取相关段。
+records=True 时返回 ProvEvent (ha-provenance 的紧凑事件记录) 而不是字典。
+"""
+import bisect
+import json
+import os
+import socket
+import sys
+from datetime import datetime, timedelta
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+# 项目根目录 (tool/ 的上一级)；ProvEvent 定义在 ha-provenance/scripts/provenance.py
+project_root = os.path.abspath(os.path.join(current_dir, ".."))
+provenance_dir = os.path.join(project_root, "ha-provenance", "scripts")
+if provenance_dir not in sys.path:
+    sys.path.append(provenance_dir)
+
+from provenance import ProvEvent
+
+
+def _as_datetime(v):
+    if v is None or isinstance(v, datetime): return v
+    return datetime.fromisoformat(str(v))
+
+
+class ProvenanceLogReader:
+    def __init__(self, index_path, records=False):
+        self.index_path = index_path
+        self.records = records
+        self.base_dir = os.path.dirname(os.path.abspath(index_path))
+        with open(index_path, 'r', encoding='utf-8') as f:
+            self.segments = json.load(f).get("segments", [])
+        self._ends = [datetime.fromisoformat(seg["end"]) for seg in self.segments]
+        self._last_ids = [seg["last_id"] for seg in self.segments]
+
+    def _select(self, start=None, end=None):
+        """与 [start, end] 有交集的段 (段按时间有序，二分定位起点)"""
+        i = bisect.bisect_left(self._ends, start) if start else 0
+        for seg in self.segments[i:]:
+            if end and datetime.fromisoformat(seg["start"]) > end: break
+            yield seg
+
+    def _iter_segment(self, seg):
+        with open(os.path.join(self.base_dir, seg["file"]), 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip(): continue
+                e = json.loads(line)
+                yield ProvEvent.from_dict(e) if self.records else e
+
+    def _with_datetime(self, seg):
+        """事件时间戳只有时分秒，以段起始时间为基准补全日期并处理跨零点"""
+        day = datetime.fromisoformat(seg["start"])
+        prev = day
+        for e in self._iter_segment(seg):
+            try:
+                t = datetime.strptime(e.get("timestamp"), "%H:%M:%S.%f").time()
+            except (TypeError, ValueError):
+                yield prev, e
+                continue
+            dt = datetime.combine(prev.date(), t)
+            if dt < prev - timedelta(minutes=1): dt += timedelta(days=1)
+            prev = dt
+            yield dt, e
+
+    def iter_events(self, start=None, end=None):
+        start, end = _as_datetime(start), _as_datetime(end)
+        for seg in self._select(start, end):
+            for dt, e in self._with_datetime(seg):
+                if start and dt < start: continue
+                if end and dt > end: return
+                yield e
+
+    def iter_ids(self, first_id=None, last_id=None):
+        i = bisect.bisect_left(self._last_ids, first_id) if first_id else 0
+        for seg in self.segments[i:]:
+            if last_id and seg["first_id"] > last_id: break
+            for e in self._iter_segment(seg):
+                eid = e.get("event_ID")
+                if first_id and eid < first_id: continue
+                if last_id and eid > last_id: return
+                yield e
+
+    def read(self, start=None, end=None):
+        return list(self.iter_events(start, end))
+
+
+def load_provenance_events(path, start=None, end=None, records=False):
+    """读取溯源事件列表；start / end 只对分段日志生效 (旧版整文件日志没有日期信息)"""
+    if path.endswith("_index.json"):
+        return ProvenanceLogReader(path, records).read(start, end)
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return [ProvEvent.from_dict(e) for e in data] if records else data
+
+
+def subscribe_events(path=None, host=None, port=None, on_gap=None):
+    """
+    订阅 ha-provenance 的实时导出 (ProvenanceExporter)，逐批 yield 事件列表。
+    on_gap(first_id, last_id) 在服务端因积压丢弃批次时回调，可用 ProvenanceLogReader.iter_ids 补读。
+    """
+    if port is not None:
+        sock = socket.create_connection((host or "127.0.0.1", port))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path or "/tmp/ha_provenance.sock")
+    with sock, sock.makefile('r', encoding='utf-8') as f:
+        for line in f:
+            msg = json.loads(line)
+            if msg.get("type") == "events":
+                yield msg["events"]
+            elif msg.get("type") == "gap" and on_gap:
+                on_gap(msg["first_id"], msg["last_id"])
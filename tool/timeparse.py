@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+时间戳归一化 (LE / appbuilder 共用)
+
+- 结果缓存：同一原始时间串只解析一次
+- 格式探测：各格式互斥时 (exclusive=True) 记住上一次命中的格式，同一数据流后续时间戳直接命中；
+  否则始终按优先级尝试 (宽松的格式可能吞掉其他格式的输入)
+- 批量转换：to_epoch 把一列时间戳向量化为 epoch 秒 (float64)
+"""
+from datetime import datetime
+
+import numpy as np
+
+
+class TimestampParser:
+    """
+    formats: 依次尝试的格式，可以是 strptime 格式串，也可以是 str -> datetime 的函数
+    normalize: 解析前的字符串预处理，返回空值视为无法解析
+    default: 无法解析时的返回值
+    exclusive: 各格式接受的输入互不重叠时才可优先尝试上一次命中的格式
+    """
+    def __init__(self, formats, normalize=None, default=None, cache_size=65536, exclusive=False):
+        self.formats = list(formats)
+        self.normalize = normalize
+        self.default = default
+        self.exclusive = exclusive
+        self.cache_size = cache_size
+        self._cache = {}
+        self._hit = 0  # 上一次命中的格式下标
+
+    def _try(self, fmt, s):
+        if callable(fmt): return fmt(s)
+        return datetime.strptime(s, fmt)
+
+    def _parse_str(self, s):
+        if not self.exclusive:
+            order = range(len(self.formats))
+        else:
+            order = [self._hit] + [i for i in range(len(self.formats)) if i != self._hit]
+        for i in order:
+            try:
+                dt = self._try(self.formats[i], s)
+            except ValueError:
+                continue
+            self._hit = i
+            return dt
+        return self.default
+
+    def __call__(self, value):
+        if isinstance(value, datetime): return value
+        if not value: return self.default
+        key = value if isinstance(value, str) else str(value)
+        cached = self._cache.get(key)
+        if cached is not None: return cached
+
+        s = self.normalize(key) if self.normalize else key
+        dt = self._parse_str(s) if s else self.default
+        if len(self._cache) >= self.cache_size: self._cache.clear()
+        if dt is not None: self._cache[key] = dt
+        return dt
+
+    def parse_many(self, values):
+        return [self(v) for v in values]
+
+    def to_epoch(self, values):
+        """批量转换为 epoch 秒；naive 时间按 UTC 处理，无法解析的位置为 NaN"""
+        dts = self.parse_many(values)
+        out = np.full(len(dts), np.nan)
+        naive_idx, naive = [], []
+        for i, dt in enumerate(dts):
+            if dt is None: continue
+            if dt.tzinfo is None:
+                naive_idx.append(i); naive.append(dt)
+            else:
+                out[i] = dt.timestamp()
+        if naive:
+            us = np.array(naive, dtype="datetime64[us]").astype(np.int64)
+            out[naive_idx] = us / 1e6
+        return out
+
+
+# ==========================================
+# 常用格式
+# ==========================================
+def parse_iso(s):
+    return datetime.fromisoformat(s)
+
+def parse_offset_iso(s, fmt="%Y-%m-%dT%H:%M:%S.%f%z"):
+    """带时区的 ISO 串：'Z' -> +0000，'+08:00' -> +0800"""
+    if s.endswith('Z'): s = s[:-1] + '+0000'
+    elif '+' in s and s[-3] == ':': s = s[:-3] + s[-2:]
+    return datetime.strptime(s, fmt)